@@ -0,0 +1,359 @@
+import argparse
+from pathlib import Path
+import json
+import sqlite3
+import tempfile
+import subprocess
+import time
+import configparser
+import fnmatch
+from datetime import datetime
+import sandbox
+
+try:
+    import tomllib
+except ImportError:
+    tomllib = None
+
+# SQLite database (in the results dir) that keeps the covered line sets of every coverage run
+DB_PATH = Path(__file__).absolute().parent.parent / "results" / "coverage.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS trials (
+    trial_key TEXT PRIMARY KEY,
+    program_name TEXT,
+    test_files TEXT,
+    percent INTEGER,
+    covered_lines INTEGER,
+    num_statements INTEGER,
+    created_at TEXT,
+    scope TEXT
+);
+CREATE TABLE IF NOT EXISTS baseline_cache (
+    cache_key TEXT PRIMARY KEY,
+    trial_key TEXT
+);
+CREATE TABLE IF NOT EXISTS files (
+    trial_key TEXT,
+    path TEXT,
+    executed BLOB,
+    missing BLOB,
+    PRIMARY KEY (trial_key, path)
+);
+"""
+
+# Coverage config files of a project in the order coverage.py reads them, with the prefix of their coverage sections
+PROJECT_CONFIGS = [(".coveragerc", ""), ("setup.cfg", "coverage:"), ("tox.ini", "coverage:"), ("pyproject.toml", "tool.coverage.")]
+
+# Test files and directories, which are never counted as covered source in the package and cut scope (in pandas,
+# matplotlib, spacy, tornado and tqdm the tests are inside the CUT's package)
+TEST_PATTERNS = ["*/tests/*", "*/test/*", "*/conftest.py", "*/test_*.py", "*_test.py"]
+
+# What a coverage run measures: the whole checkout (all), the package that contains the CUT file (package), or only the
+# CUT file (cut)
+COV_SCOPES = ["all", "package", "cut"]
+
+# Python version of every interpreter that ran coverage (sys.monitoring needs 3.12)
+PYTHON_VERSIONS = {}
+
+# Open (and create if needed) the coverage database. Databases from before the scope column get it added (their trials
+# have no scope)
+def connect(db_path=DB_PATH):
+    conn = sqlite3.connect(str(db_path))
+    conn.executescript(SCHEMA)
+    if "scope" not in [row[1] for row in conn.execute("PRAGMA table_info(trials)")]:
+        with conn:
+            conn.execute("ALTER TABLE trials ADD COLUMN scope TEXT")
+    return conn
+
+# Key of a stored coverage run, e.g. baseline/ansible_1 or results_LLAMA_EXTENDCOV/ansible_1/test_errors_LLAMA_TESTCUT.py
+def trial_key(stage, program_name, test_file=None):
+    key = f"{stage}/{program_name}"
+    if test_file:
+        key += f"/{test_file}"
+    return key
+
+# Pack a set of line numbers into a bitmap (bit n is set if line n is in the set)
+def pack_lines(lines):
+    bitmap = bytearray((max(lines, default=0) >> 3) + 1)
+    for line in lines:
+        bitmap[line >> 3] |= 1 << (line & 7)
+    return bytes(bitmap)
+
+# Unpack a bitmap back into a set of line numbers
+def unpack_lines(bitmap):
+    return {
+        (index << 3) + bit
+        for index, byte in enumerate(bitmap) if byte
+        for bit in range(8) if byte >> bit & 1
+    }
+
+# Percentage as shown in coverage.py's reports (only 0 and 100 when nothing or everything is covered)
+def display_percent(covered_lines, num_statements):
+    if num_statements == 0:
+        return 100
+    percent = 100.0 * covered_lines / num_statements
+    if 0 < percent < 1:
+        return 1
+    if 99 < percent < 100:
+        return 99
+    return int(round(percent))
+
+# Read a coverage.py JSON report (--cov-report=json) into {file path: (executed lines, missing lines)}
+def read_json_report(json_path):
+    try:
+        report = json.loads(Path(json_path).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+
+    return {
+        path: (set(data["executed_lines"]), set(data["missing_lines"]))
+        for path, data in report["files"].items()
+    }
+
+# Totals of a coverage run: (covered lines, statements, percentage)
+def totals(files):
+    covered_lines = sum(len(executed) for executed, _ in files.values())
+    num_statements = sum(len(executed | missing) for executed, missing in files.values())
+    return covered_lines, num_statements, display_percent(covered_lines, num_statements)
+
+# Top-level package that contains a CUT file, relative to the checkout (e.g. lib/ansible for lib/ansible/errors/__init__.py),
+# or the module name of a CUT file that isn't in a package (e.g. black for black.py)
+def cut_package(project_dir, cut_file):
+    path = Path(cut_file)
+    if not (Path(project_dir) / path.parent / "__init__.py").exists():
+        return path.stem
+
+    package = path.parent
+    while package.parent != Path(".") and (Path(project_dir) / package.parent / "__init__.py").exists():
+        package = package.parent
+    return str(package)
+
+# Add the option that sets what coverage runs measure
+def add_scope_argument(parser):
+    parser.add_argument(
+        "--cov-scope",
+        choices=COV_SCOPES,
+        default="package",
+        help="all = measure the whole checkout, package = the package that contains the CUT file, cut = only the CUT file "
+             "(use the same scope for p02, p05 and p06)."
+    )
+
+# Coverage settings of a project ({section: {option: value}}), from the first of its config files that has any, like
+# coverage.py itself (pyproject.toml is only read on Python 3.11+)
+def project_coverage_config(project_dir):
+    for name, prefix in PROJECT_CONFIGS:
+        path = Path(project_dir) / name
+        if not path.is_file():
+            continue
+
+        if name == "pyproject.toml":
+            if tomllib is None:
+                continue
+            try:
+                sections = tomllib.loads(path.read_text(encoding="utf-8")).get("tool", {}).get("coverage", {})
+            except (OSError, ValueError, UnicodeDecodeError):
+                continue
+            config = {
+                section: {option: config_value(value) for option, value in options.items()}
+                for section, options in sections.items() if isinstance(options, dict)
+            }
+        else:
+            parser = configparser.RawConfigParser()
+            try:
+                parser.read(path, encoding="utf-8")
+            except (configparser.Error, UnicodeDecodeError):
+                continue
+            config = {
+                section[len(prefix):]: dict(parser.items(section))
+                for section in parser.sections() if section.startswith(prefix)
+            }
+
+        if config:
+            return config
+    return {}
+
+# A value of pyproject.toml as it is written in a coveragerc (lists one per line)
+def config_value(value):
+    if isinstance(value, bool):
+        return str(value).lower()
+    if isinstance(value, list):
+        return "\n" + "\n".join(str(item) for item in value)
+    return str(value)
+
+# Whether a measured file is a test file or lies in a test directory
+def is_test_path(path):
+    path = "/" + Path(path).as_posix()
+    return any(fnmatch.fnmatch(path, pattern) for pattern in TEST_PATTERNS)
+
+# Line sets without the test files (see TEST_PATTERNS)
+def without_tests(files):
+    return {path: lines for path, lines in files.items() if not is_test_path(path)}
+
+# Text of the coveragerc of a coverage run with the given scope. It replaces the project's own coverage config, so that
+# config's settings (omit, branch, plugins, ...) are copied into it. Only the CUT's package is traced for both the package
+# and the cut scope (with `include` instead, coverage writes no report at all for tests that never import the CUT file),
+# and test files are omitted there
+def coveragerc_text(project_dir, cut_file, scope):
+    config = project_coverage_config(project_dir)
+    run = config.setdefault("run", {})
+    if scope in ["package", "cut"]:
+        run.pop("include", None)
+        run["source"] = "\n" + cut_package(project_dir, cut_file)
+        run["omit"] = run.get("omit", "") + "\n" + "\n".join(TEST_PATTERNS)
+
+    lines = []
+    for section, options in config.items():
+        lines.append(f"[{section}]")
+        lines += [f"{option} = " + value.replace("\n", "\n    ") for option, value in options.items()]
+    return "\n".join(lines) + "\n"
+
+# Write the coveragerc of a coverage run with the given scope
+def write_coveragerc(rc_path, project_dir, cut_file, scope):
+    Path(rc_path).write_text(coveragerc_text(project_dir, cut_file, scope), encoding="utf-8")
+
+# Environment of a coverage run: the low-overhead sys.monitoring tracer on Python 3.12 and newer (coverage.py 7.4+)
+def coverage_env(python):
+    if python not in PYTHON_VERSIONS:
+        result = subprocess.run(
+            [str(python), "-c", "import sys; print(sys.version_info[0], sys.version_info[1])"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True
+        )
+        PYTHON_VERSIONS[python] = tuple(int(part) for part in result.stdout.split()) if result.returncode == 0 else None
+
+    if PYTHON_VERSIONS[python] and PYTHON_VERSIONS[python] >= (3, 12):
+        return {"COVERAGE_CORE": "sysmon"}
+    return {}
+
+# Run test files with pytest --cov in the sandbox and read the line sets from its JSON report (None if coverage couldn't
+# be collected, or the run was stopped by a limit). With a `cut_file`, coverage is measured in the given scope (see
+# COV_SCOPES), otherwise for the whole checkout. Returns the completed process, the line sets, the exec status and the
+# seconds the run took
+def pytest_coverage(python, project_dir, test_files, stderr=None, limits=None, cut_file=None, scope="all", pytest_args=()):
+    with tempfile.TemporaryDirectory() as report_dir:
+        json_path = Path(report_dir) / "coverage.json"
+        rc_path = Path(report_dir) / "coveragerc"
+        write_coveragerc(rc_path, project_dir, cut_file, scope if cut_file else "all")
+
+        start = time.perf_counter()
+        result, status = sandbox.run(
+            [str(python), "-m", "pytest"] + [str(test_file) for test_file in test_files] + list(pytest_args) +
+            ["--cov", f"--cov-config={rc_path}", "--cov-report=term", f"--cov-report=json:{json_path}"],
+            project_dir,
+            limits,
+            stderr,
+            coverage_env(python)
+        )
+        seconds = time.perf_counter() - start
+        files = read_json_report(json_path) if status == sandbox.OK else None
+
+    # The cut scope only keeps the line sets of the CUT file, and the package scope never counts test files
+    if files is not None and cut_file and scope == "cut":
+        files = {path: lines for path, lines in files.items() if Path(path).as_posix() == Path(cut_file).as_posix()}
+    elif files is not None and cut_file and scope == "package":
+        files = without_tests(files)
+    return result, files, status, seconds
+
+# Store (or replace) the line sets of a coverage run, with the coverage scope it was measured in
+def save_trial(conn, key, program_name, test_files, files, scope=None):
+    covered_lines, num_statements, percent = totals(files)
+
+    with conn:
+        conn.execute("DELETE FROM files WHERE trial_key = ?", (key,))
+        conn.execute(
+            "INSERT OR REPLACE INTO trials VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (key, program_name, " ".join(test_files), percent, covered_lines, num_statements,
+             datetime.now().isoformat(timespec="seconds"), scope)
+        )
+        conn.executemany(
+            "INSERT INTO files VALUES (?, ?, ?, ?)",
+            [(key, path, pack_lines(executed), pack_lines(missing)) for path, (executed, missing) in files.items()]
+        )
+    return percent
+
+# Load the line sets of a stored coverage run (None if it was never stored)
+def load_trial(conn, key):
+    if conn.execute("SELECT 1 FROM trials WHERE trial_key = ?", (key,)).fetchone() is None:
+        return None
+
+    rows = conn.execute("SELECT path, executed, missing FROM files WHERE trial_key = ?", (key,))
+    return {path: (unpack_lines(executed), unpack_lines(missing)) for path, executed, missing in rows}
+
+# Coverage scope a stored run was measured in (None if it was never stored, or stored before scopes were recorded)
+def trial_scope(conn, key):
+    row = conn.execute("SELECT scope FROM trials WHERE trial_key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+# Find a stored run with the same inputs (a content hash of its measured files, environment and coverage scope)
+def find_cached(conn, cache_key):
+    row = conn.execute("SELECT trial_key FROM baseline_cache WHERE cache_key = ?", (cache_key,)).fetchone()
+    return row[0] if row else None
+
+# Remember which stored run belongs to a content hash
+def save_cached(conn, cache_key, key):
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO baseline_cache VALUES (?, ?)", (cache_key, key))
+
+# Combine coverage runs like `coverage combine`: a line is covered if any run executed it
+def union(*trials):
+    combined = {}
+    for files in trials:
+        for path, (executed, missing) in files.items():
+            all_executed, all_missing = combined.get(path, (set(), set()))
+            combined[path] = (all_executed | executed, all_missing | missing)
+
+    return {path: (executed, missing - executed) for path, (executed, missing) in combined.items()}
+
+# Coverage percentage of every file of a coverage run
+def file_percents(files):
+    return {
+        path: display_percent(len(executed), len(executed | missing))
+        for path, (executed, missing) in sorted(files.items())
+    }
+
+# Lines covered by `after` but not by `before`, per file
+def new_lines(before, after):
+    return {
+        path: executed - before.get(path, (set(), set()))[0]
+        for path, (executed, _) in after.items()
+        if executed - before.get(path, (set(), set()))[0]
+    }
+
+# Query stored coverage runs without running pytest again
+def main():
+    parser = argparse.ArgumentParser(description="query the line coverage stored by p02 and p06.")
+
+    parser.add_argument(
+        "keys",
+        nargs="+",
+        help="trial keys to show, e.g. baseline/ansible_1 (a second key shows the lines it covers in addition to the first)."
+    )
+
+    args = parser.parse_args()
+    conn = connect()
+
+    trials = []
+    for key in args.keys:
+        files = load_trial(conn, key)
+        if files is None:
+            raise SystemExit(f"Unknown trial key: {key}")
+        trials.append(files)
+
+    for key, files in zip(args.keys, trials):
+        covered_lines, num_statements, percent = totals(files)
+        print(f"\n{key}: {covered_lines}/{num_statements} statements ({percent}%, scope={trial_scope(conn, key)})")
+        for path, percent in file_percents(files).items():
+            print(f"  {percent:>3}%  {path}")
+
+    if len(trials) > 1:
+        combined = union(*trials)
+        covered_lines, num_statements, percent = totals(combined)
+        print(f"\nUNION: {covered_lines}/{num_statements} statements ({percent}%)")
+        print(f"NEW LINES IN {args.keys[-1]} (compared to {args.keys[0]}):")
+        for path, lines in new_lines(trials[0], trials[-1]).items():
+            print(f"  {path}: {sorted(lines)}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+import ast
+
+# Rough number of characters per token, used to turn the token budget into a text size
+CHARS_PER_TOKEN = 4
+
+# Names used by a test class: identifiers, attribute names (e.g. obj.method) and imported names
+def referenced_names(test_source):
+    names = set()
+
+    for node in ast.walk(ast.parse(test_source)):
+        if isinstance(node, ast.Name):
+            names.add(node.id)
+        elif isinstance(node, ast.Attribute):
+            names.add(node.attr)
+        elif isinstance(node, ast.alias):
+            names.update(node.name.split("."))
+            if node.asname:
+                names.add(node.asname)
+    return names
+
+# Check if a statement is a docstring
+def is_docstring(node):
+    return isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant) and isinstance(node.value.value, str)
+
+# First line of a definition, including its decorators
+def start_line(node):
+    return min([node.lineno] + [decorator.lineno for decorator in node.decorator_list])
+
+# Source of a definition without its body: the signature, the docstring (if any) and "..."
+def signature(node, lines):
+    body = node.body
+    if body[0].lineno == node.lineno:
+        return "".join(lines[start_line(node) - 1:node.end_lineno])
+
+    end = body[0].lineno - 1
+    if is_docstring(body[0]):
+        end = body[0].end_lineno
+
+    indent = " " * body[0].col_offset
+    return "".join(lines[start_line(node) - 1:end]) + f"{indent}...\n"
+
+# Split a CUT into pieces that can be kept in full, reduced to their signature, or dropped:
+# module-level statements, functions, classes (their header) and methods
+def split_pieces(tree, lines, names):
+    pieces = []
+
+    def add(node, parent, referenced, kind):
+        full = "".join(lines[(start_line(node) if hasattr(node, "decorator_list") else node.lineno) - 1:node.end_lineno])
+        stub = signature(node, lines) if kind == "def" else full
+        pieces.append({"full": full, "stub": stub, "referenced": referenced, "kind": kind, "parent": parent, "state": "full"})
+
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            add(node, None, node.name in names, "def")
+
+        elif isinstance(node, ast.ClassDef):
+            # The class header keeps the class statement and its docstring
+            class_referenced = node.name in names
+            body = node.body
+            if body[0].lineno == node.lineno:
+                header_end = node.lineno
+            elif is_docstring(body[0]):
+                header_end = body[0].end_lineno
+                body = body[1:]
+            else:
+                header_end = body[0].lineno - 1
+
+            header = "".join(lines[start_line(node) - 1:header_end])
+            header_index = len(pieces)
+            pieces.append({"full": header, "stub": header, "referenced": class_referenced, "kind": "header", "parent": None, "state": "full"})
+
+            for child in body:
+                if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                    referenced = child.name in names or (class_referenced and child.name == "__init__")
+                    add(child, header_index, referenced, "def")
+                else:
+                    add(child, header_index, class_referenced, "other")
+
+        # Imports (also inside try/except ImportError) and the module docstring are always kept
+        elif any(isinstance(child, (ast.Import, ast.ImportFrom)) for child in ast.walk(node)) or is_docstring(node):
+            add(node, None, True, "import")
+
+        else:
+            targets = {target.id for target in ast.walk(node) if isinstance(target, ast.Name)}
+            add(node, None, bool(targets & names), "other")
+    return pieces
+
+# Join the pieces that are kept (a class header is kept if the class or one of its members is)
+def render(pieces):
+    used_headers = {piece["parent"] for piece in pieces if piece["parent"] is not None and piece["state"] != "dropped"}
+
+    parts = []
+    for index, piece in enumerate(pieces):
+        if piece["kind"] == "header":
+            if piece["referenced"] or index in used_headers:
+                parts.append(piece["full"])
+        elif piece["state"] == "full":
+            parts.append(piece["full"])
+        elif piece["state"] == "stub":
+            parts.append(piece["stub"])
+    return "".join(parts)
+
+# Reduce a CUT to what the test class uses: referenced functions, classes and methods in full, everything else as
+# signatures and docstrings. If that is still over `token_budget`, unreferenced code is dropped and then the largest
+# referenced bodies are reduced to signatures. Returns the CUT unchanged if it can't be parsed
+def slice_cut(cut_source, test_source, token_budget):
+    try:
+        tree = ast.parse(cut_source)
+        names = referenced_names(test_source)
+    except SyntaxError:
+        return cut_source
+
+    lines = cut_source.splitlines(keepends=True)
+    pieces = split_pieces(tree, lines, names)
+    max_chars = token_budget * CHARS_PER_TOKEN
+
+    for piece in pieces:
+        if piece["kind"] == "def" and not piece["referenced"]:
+            piece["state"] = "stub"
+        elif piece["kind"] == "other" and not piece["referenced"]:
+            piece["state"] = "dropped"
+
+    # Drop unreferenced signatures, from the end of the file
+    for piece in reversed(pieces):
+        if len(render(pieces)) <= max_chars:
+            break
+        if piece["kind"] == "def" and not piece["referenced"]:
+            piece["state"] = "dropped"
+
+    # Reduce the largest referenced bodies to their signatures
+    for piece in sorted(pieces, key=lambda piece: len(piece["full"]), reverse=True):
+        if len(render(pieces)) <= max_chars:
+            break
+        if piece["kind"] == "def" and piece["state"] == "full" and piece["full"] != piece["stub"]:
+            piece["state"] = "stub"
+
+    return render(pieces)
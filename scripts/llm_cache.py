@@ -0,0 +1,62 @@
+from pathlib import Path
+import json
+import sqlite3
+import hashlib
+import time
+
+# SQLite database (in the results dir) that keeps every LLM response with its token counts and latency
+DB_PATH = Path(__file__).absolute().parent.parent / "results" / "llm_cache.db"
+
+# read = use cached responses only (never call the model), write = use and store responses, refresh = replace cached responses, off = no cache
+CACHE_MODES = ["read", "write", "off", "refresh"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    model TEXT,
+    content TEXT,
+    metadata TEXT,
+    size INTEGER,
+    created_at REAL,
+    last_used REAL
+);
+"""
+
+# Open (and create if needed) the response cache
+def connect(db_path=DB_PATH):
+    conn = sqlite3.connect(str(db_path))
+    conn.executescript(SCHEMA)
+    return conn
+
+# Hash the model, the prompt and the sampling options into the key of a response
+def make_key(model, prompt, options):
+    data = json.dumps([model, prompt, options], sort_keys=True)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+# Look up a cached response and mark it as recently used (returns (content, metadata) or None)
+def get(conn, key):
+    row = conn.execute("SELECT content, metadata FROM responses WHERE key = ?", (key,)).fetchone()
+    if row is None:
+        return None
+
+    with conn:
+        conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+    return row[0], json.loads(row[1])
+
+# Store a response, then evict the least recently used responses until the cache fits in `max_bytes`
+def put(conn, key, model, content, metadata, max_bytes):
+    size = len(content.encode("utf-8"))
+    now = time.time()
+
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (key, model, content, json.dumps(metadata), size, now, now)
+        )
+
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        for old_key, old_size in conn.execute("SELECT key, size FROM responses ORDER BY last_used").fetchall():
+            if total <= max_bytes:
+                break
+            conn.execute("DELETE FROM responses WHERE key = ?", (old_key,))
+            total -= old_size
@@ -0,0 +1,384 @@
+import argparse
+from pathlib import Path
+import json
+import time
+import hashlib
+import threading
+import re
+import os
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import pandas as pd
+import llm_cache
+
+TEST_FILES = {
+    "ansible": "test/units/errors/test_errors.py",
+    "black": "tests/test_black.py",
+    "calculator": "tests/test_calc.py",
+    "cookiecutter": "tests/test_generate_file.py",
+    "expression": "tests/test_expression.py",
+    "fastapi": "tests/test_jsonable_encoder.py",
+    "httpie": "tests/test_exit_status.py",
+    "keras": "tests/test_loss_masking.py",
+    "luigi": "test/factorial_test.py",
+    "markup": "tests/test_markup.py",
+    "matplotlib": "lib/matplotlib/tests/test_container.py",
+    "middle": "tests/test_middle.py",
+    "pandas": "pandas/tests/arithmetic/test_numeric.py",
+    "pysnooper": "tests/test_pysnooper.py",
+    "sanic": "tests/test_middleware.py",
+    "scrapy": "tests/test_command_fetch.py",
+    "spacy": "spacy/tests/tokenizer/test_tokenizer.py",
+    "thefuck": "tests/test_logs.py",
+    "tornado": "tornado/test/escape_test.py",
+    "tqdm": "tqdm/tests/tests_tqdm.py",
+    "youtubedl": "test/test_age_restriction.py"
+}
+
+LLMS = {
+    "llama": "llama3.2:3b",
+    "deepseek": "deepseek-coder:6.7b"
+}
+
+# Rough number of characters per token, used to turn text sizes into token counts and durations
+CHARS_PER_TOKEN = 4
+
+# Number of characters sent per chunk of a streamed response
+CHUNK_CHARS = 16
+
+# Test class returned when no recorded response matches the prompt
+SYNTHETIC_TEST = '''Here is an extended version of the test class:
+
+```python
+import unittest
+
+
+class TestExtended{number}(unittest.TestCase):
+{tests}
+
+if __name__ == "__main__":
+    unittest.main()
+```
+'''
+
+SYNTHETIC_CASE = '''    def test_case_{index}(self):
+        self.assertEqual({index} + {index}, {total})
+'''
+
+# Recorded LLM test files of earlier runs, indexed by model tag and by the original test class they extend
+def load_recorded(csv_files, tmp_dir):
+    recorded = {}
+
+    for csv_file in csv_files:
+        df = pd.read_csv(csv_file)
+        df = df[df["llm_test_file"].notna()]
+
+        for _, row in df.iterrows():
+            program_name = row["program_name"]
+            project = program_name.split("_")[0]
+            llm_test_file = str(row["llm_test_file"])
+
+            # The model is part of the LLM test file name (e.g. test_calc_LLAMA_TESTCUT.py)
+            model = next((LLMS[name] for name in LLMS if f"_{name.upper()}_" in llm_test_file), None)
+            original_test_file = tmp_dir / program_name / TEST_FILES[project]
+
+            try:
+                existing_test_class = original_test_file.read_text(encoding="utf-8")
+                llm_response = original_test_file.with_name(llm_test_file).read_text(encoding="utf-8")
+            except (FileNotFoundError, UnicodeDecodeError):
+                continue
+
+            responses = recorded.setdefault(model, {}).setdefault(existing_test_class, [])
+            if llm_response not in responses:
+                responses.append(llm_response)
+    return recorded
+
+# Pick one of `choices` from a hash of the prompt and sampling options, so that the same request always gets the same answer
+def pick(choices, prompt, options):
+    digest = hashlib.sha256(json.dumps([prompt, options], sort_keys=True).encode("utf-8")).digest()
+    return choices[int.from_bytes(digest[:4], "big") % len(choices)]
+
+# Answer a prompt: a cached response, a recorded LLM test file whose test class is in the prompt, or a synthetic test class
+def respond(server, model, prompt, options):
+    # Each request thread opens its own connection (SQLite connections can't be shared between threads)
+    if server.use_cache:
+        conn = llm_cache.connect()
+        try:
+            cached = llm_cache.get(conn, llm_cache.make_key(model, prompt, options))
+        finally:
+            conn.close()
+        if cached is not None:
+            return cached[0], "cache"
+
+    # Longer test classes first, so a test class that contains another one wins
+    for existing_test_class, responses in sorted(server.recorded.get(model, {}).items(), key=lambda item: -len(item[0])):
+        if existing_test_class.strip() and existing_test_class.strip() in prompt:
+            return pick(responses, prompt, options), "recorded"
+
+    number = pick(list(range(1000)), prompt, options)
+    tests = "\n".join(
+        SYNTHETIC_CASE.format(index=index, total=2 * index)
+        for index in range(1, 2 + number % server.max_tests)
+    )
+    return SYNTHETIC_TEST.format(number=number, tests=tests), "synthetic"
+
+# Convert an Ollama duration (seconds, or a string like 30s, 5m, 1h) into seconds (negative = keep loaded forever)
+def parse_duration(keep_alive, default):
+    if keep_alive is None:
+        return default
+    if isinstance(keep_alive, (int, float)):
+        return keep_alive
+
+    match = re.fullmatch(r"(-?[\d.]+)(ms|s|m|h)?", str(keep_alive))
+    if match is None:
+        return default
+    scale = {"ms": 0.001, "s": 1, "m": 60, "h": 3600, None: 1}[match.group(2)]
+    return float(match.group(1)) * scale
+
+# Wait while the model is "loaded" if it isn't resident anymore (returns the load time in seconds)
+def load_model(server, model, keep_alive):
+    with server.lock:
+        now = time.perf_counter()
+        loaded_until = server.loaded.get(model)
+        load_time = 0 if loaded_until is not None and (loaded_until < 0 or now <= loaded_until) else server.load_time
+
+        keep_seconds = parse_duration(keep_alive, server.keep_alive)
+        server.loaded[model] = -1 if keep_seconds < 0 else now + load_time + keep_seconds
+    time.sleep(load_time)
+    return load_time
+
+class MockOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    # "Ollama is running" check and model list
+    def do_GET(self):
+        if self.path == "/api/tags":
+            self.send_json({"models": [{"name": model, "model": model} for model in LLMS.values()]})
+        else:
+            self.send_text("Ollama is running")
+
+    def do_HEAD(self):
+        self.send_text("")
+
+    # /api/chat and /api/generate, streamed as JSON lines or answered at once like Ollama
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        model = body.get("model", "")
+
+        if self.path == "/api/chat":
+            prompt = "\n".join(message.get("content", "") for message in body.get("messages", []))
+        elif self.path == "/api/generate":
+            prompt = body.get("prompt", "")
+        else:
+            self.send_json({"error": f"unknown endpoint {self.path}"}, status=404)
+            return
+
+        server = self.server
+        options = body.get("options") or {}
+
+        with server.slots:
+            load_time = load_model(server, model, body.get("keep_alive"))
+
+            # A request without a prompt only loads the model
+            if not prompt:
+                self.send_json(self.final_chunk(model, "", 0, 0, load_time, 0, 0))
+                return
+
+            content, source = respond(server, model, prompt, options)
+            print(f"{self.path} {model}: {source} response ({len(content)} characters)")
+
+            # Like Ollama, only the part of the prompt that differs from the previous prompt of the model is evaluated
+            with server.lock:
+                shared = len(os.path.commonprefix([server.last_prompt.get(model, ""), prompt]))
+                server.last_prompt[model] = prompt
+            prompt_tokens = max(1, (len(prompt) - shared) // CHARS_PER_TOKEN)
+            prompt_time = server.latency + prompt_tokens / server.prompt_rate
+            time.sleep(prompt_time)
+
+            if body.get("stream", True):
+                self.stream(model, content, prompt_tokens, prompt_time, load_time)
+            else:
+                eval_tokens = max(1, len(content) // CHARS_PER_TOKEN)
+                eval_time = eval_tokens / server.token_rate
+                time.sleep(eval_time)
+                self.send_json(self.final_chunk(model, content, prompt_tokens, eval_tokens, load_time, prompt_time, eval_time))
+
+    # Send a response chunk by chunk at the configured token rate (stops when the client closes the connection)
+    def stream(self, model, content, prompt_tokens, prompt_time, load_time):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        start = time.perf_counter()
+        try:
+            for offset in range(0, len(content), CHUNK_CHARS):
+                time.sleep(CHUNK_CHARS / CHARS_PER_TOKEN / self.server.token_rate)
+                self.write_chunk(self.chunk(model, content[offset:offset + CHUNK_CHARS], done=False))
+
+            eval_tokens = max(1, len(content) // CHARS_PER_TOKEN)
+            final = self.final_chunk(model, "", prompt_tokens, eval_tokens, load_time, prompt_time, time.perf_counter() - start)
+            self.write_chunk(final)
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            print(f"STREAM FOR {model} CLOSED BY CLIENT")
+
+    def write_chunk(self, data):
+        line = (json.dumps(data) + "\n").encode("utf-8")
+        self.wfile.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+        self.wfile.flush()
+
+    def chunk(self, model, content, done):
+        data = {
+            "model": model,
+            "created_at": datetime.now(timezone.utc).isoformat().replace("+00:00", "Z"),
+            "done": done,
+        }
+        if self.path == "/api/chat":
+            data["message"] = {"role": "assistant", "content": content}
+        else:
+            data["response"] = content
+        return data
+
+    # Last chunk of a response, with Ollama's token counts and durations (in nanoseconds)
+    def final_chunk(self, model, content, prompt_tokens, eval_tokens, load_time, prompt_time, eval_time):
+        data = self.chunk(model, content, done=True)
+        data.update({
+            "done_reason": "stop" if content or eval_tokens else "load",
+            "total_duration": int((load_time + prompt_time + eval_time) * 1e9),
+            "load_duration": int(load_time * 1e9),
+            "prompt_eval_count": prompt_tokens,
+            "prompt_eval_duration": int(prompt_time * 1e9),
+            "eval_count": eval_tokens,
+            "eval_duration": int(eval_time * 1e9),
+        })
+        return data
+
+    def send_json(self, data, status=200):
+        self.send_body(json.dumps(data).encode("utf-8"), "application/json", status)
+
+    def send_text(self, text):
+        self.send_body(text.encode("utf-8"), "text/plain", 200)
+
+    def send_body(self, data, content_type, status):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+# Serve the Ollama chat API locally with recorded or synthetic responses, to test and benchmark p03 without a model
+def main():
+    parser = argparse.ArgumentParser(description="run a stand-in for the Ollama server that answers with recorded or synthetic test classes.")
+
+    parser.add_argument(
+        "--host",
+        default="127.0.0.1",
+        help="address to listen on."
+    )
+
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=11435,
+        help="port to listen on (point the pipeline at it with OLLAMA_HOST=http://127.0.0.1:<port>)."
+    )
+
+    parser.add_argument(
+        "-r", "--replay",
+        nargs="*",
+        default=[],
+        help="CSV filenames in results directory whose LLM test files (in scripts/tmp) are replayed for matching prompts."
+    )
+
+    parser.add_argument(
+        "--use-cache",
+        action="store_true",
+        help="also replay responses stored in the response cache (results/llm_cache.db)."
+    )
+
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="fixed delay in seconds before every response."
+    )
+
+    parser.add_argument(
+        "--prompt-rate",
+        type=float,
+        default=2000.0,
+        help="prompt tokens evaluated per second."
+    )
+
+    parser.add_argument(
+        "--token-rate",
+        type=float,
+        default=200.0,
+        help="response tokens generated per second."
+    )
+
+    parser.add_argument(
+        "--load-time",
+        type=float,
+        default=0.0,
+        help="seconds to load a model that isn't resident (models stay resident for their keep_alive)."
+    )
+
+    parser.add_argument(
+        "--keep-alive",
+        default="5m",
+        help="how long a model stays resident when a request doesn't set keep_alive."
+    )
+
+    parser.add_argument(
+        "--parallel",
+        type=int,
+        default=1,
+        help="number of requests answered at the same time (like OLLAMA_NUM_PARALLEL)."
+    )
+
+    parser.add_argument(
+        "--max-tests",
+        type=int,
+        default=5,
+        help="maximum number of test methods in a synthetic test class."
+    )
+
+    args = parser.parse_args()
+    if args.parallel < 1:
+        raise SystemExit("Invalid --parallel. Use 1 or more requests.")
+    if args.prompt_rate <= 0 or args.token_rate <= 0:
+        raise SystemExit("Invalid --prompt-rate/--token-rate. Use a rate above 0.")
+
+    scripts_dir = Path(__file__).absolute().parent
+    results_dir = scripts_dir.parent / "results"
+
+    server = ThreadingHTTPServer((args.host, args.port), MockOllamaHandler)
+    server.recorded = load_recorded([results_dir / name for name in args.replay], scripts_dir / "tmp")
+    server.use_cache = args.use_cache
+    server.latency = args.latency
+    server.prompt_rate = args.prompt_rate
+    server.token_rate = args.token_rate
+    server.load_time = args.load_time
+    server.keep_alive = parse_duration(args.keep_alive, 300)
+    server.max_tests = max(1, args.max_tests)
+    server.slots = threading.BoundedSemaphore(args.parallel)
+    server.lock = threading.Lock()
+    server.loaded = {}
+    server.last_prompt = {}
+
+    num_recorded = sum(len(responses) for tests in server.recorded.values() for responses in tests.values())
+    print(f"RECORDED RESPONSES: {num_recorded}")
+    print(f"MOCK OLLAMA SERVER RUNNING ON http://{args.host}:{args.port} (OLLAMA_HOST=http://{args.host}:{args.port})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,15 @@ import argparse
 from pathlib import Path
 import sys
 import subprocess
+import shutil
+import time
+import csv
+import json
+import os
+import stat
+import hashlib
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # program name, num bugs (from t4p info (Tests4Py info command))
 PROJECTS = {
@@ -28,30 +37,237 @@ PROJECTS = {
     "youtubedl": 43,
 }
 
+# Written inside a checkout only after t4p checkout has finished successfully
+MARKER_FILE = ".t4p_checkout_done"
+
+# Records the outcome and wall time of every checkout (stored in the tmp dir next to the checkouts)
+MANIFEST_FILE = "checkout_manifest.csv"
+MANIFEST_COLUMNS = ["program_name", "status", "returncode", "wall_time", "num_files", "shared_bytes", "finished_at"]
+
+# Content-addressed store (one per project) holding a single copy of every file shared by its buggy versions
+STORE_DIR = ".store"
+WRITE_BITS = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+
 # Get all selected projects to be retrieved
 def select_projects(project):
     # Single project
     if project:
         if project not in PROJECTS:
             sys.exit(f"Unknown project: {project}\nTests4Py projects:\n" + "\n".join(PROJECTS.keys()))
-        chosen_projects = {project: PROJECTS[project]} 
+        chosen_projects = {project: PROJECTS[project]}
 
     else:
         chosen_projects = PROJECTS
     return chosen_projects
 
-# Retrieve all chosen project(s) by using t4p checkout
-def t4p_checkout(chosen_projects, t4p, tmp_dir, scripts_dir):
+# Count the files of a checkout, not including the marker (used to check that no files of a completed checkout are missing)
+def count_files(checkout_dir):
+    num_files = sum(len(files) for _, _, files in os.walk(checkout_dir))
+    return num_files - (checkout_dir / MARKER_FILE).exists()
+
+# Check if a buggy version was already checked out completely by an earlier (possibly interrupted) run
+def is_checked_out(checkout_dir, verify):
+    marker = checkout_dir / MARKER_FILE
+
+    if not marker.exists():
+        return False
+    if not verify:
+        return True
+
+    num_files = read_marker(checkout_dir).get("num_files")
+    if num_files is None:
+        return False
+
+    # Later scripts add files to the checkout (e.g. LLM test files), so only missing files count as damage
+    return count_files(checkout_dir) >= num_files
+
+# Hash a file's content together with its executable bit (hard links share the mode, so both must match)
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    executable = "x" if os.access(path, os.X_OK) else "-"
+    return digest.hexdigest() + executable
+
+# Replace every file of a checkout with a hard link into the project's store, so identical files are stored once
+def dedupe_checkout(checkout_dir, store_dir):
+    shared_bytes = 0
+
+    for root, _, files in os.walk(checkout_dir):
+        for name in files:
+            path = Path(root) / name
+            if name == MARKER_FILE or path.is_symlink():
+                continue
+
+            key = hash_file(path)
+            stored_file = store_dir / key[:2] / key
+            stored_file.parent.mkdir(parents=True, exist_ok=True)
+
+            # The first checkout that has this content becomes the stored copy.
+            # Shared files are read-only so that an in-place write cannot leak into other buggy versions
+            try:
+                os.link(path, stored_file)
+                stored_file.chmod(stored_file.stat().st_mode & ~WRITE_BITS)
+                continue
+            except FileExistsError:
+                pass
+
+            if os.path.samefile(path, stored_file):
+                continue
+
+            # Link through a temporary name so the checkout never has a missing file
+            link_path = path.with_name(name + ".t4p_link")
+            os.link(stored_file, link_path)
+            os.replace(link_path, path)
+            shared_bytes += stored_file.stat().st_size
+
+    return shared_bytes
+
+# Delete a checkout, including read-only files shared with the store (needed on Windows)
+def remove_checkout(checkout_dir):
+    def make_writable(function, path, _):
+        os.chmod(path, os.stat(path).st_mode | stat.S_IWUSR)
+        function(path)
+
+    shutil.rmtree(checkout_dir, onerror=make_writable)
+
+# Read the marker of a completed checkout
+def read_marker(checkout_dir):
+    try:
+        return json.loads((checkout_dir / MARKER_FILE).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+
+# Read the manifest of earlier runs so that its records are kept when resuming
+def read_manifest(manifest_path):
+    if not manifest_path.exists():
+        return {}
+
+    with open(manifest_path, newline="", encoding="utf-8") as csv_file:
+        return {row["program_name"]: row for row in csv.DictReader(csv_file)}
+
+# Rewrite the manifest through a temporary file so that an interruption never leaves it half written
+def write_manifest(manifest_path, manifest):
+    tmp_path = manifest_path.with_suffix(".tmp")
+
+    with open(tmp_path, "w", newline="", encoding="utf-8") as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=MANIFEST_COLUMNS)
+        writer.writeheader()
+        writer.writerows(manifest[name] for name in sorted(manifest))
+    os.replace(tmp_path, manifest_path)
+
+# Run t4p checkout for a single buggy version and record how long it took
+def checkout_bug(project, bug_id, t4p, tmp_dir, scripts_dir, storage):
+    program_name = f"{project}_{bug_id}"
+    checkout_dir = tmp_dir / program_name
+
+    # A directory without a marker is left over from an interrupted or failed checkout of this script (or --force was
+    # given), so start it over
+    if checkout_dir.exists():
+        remove_checkout(checkout_dir)
+
+    print(f"RUNNING: t4p checkout -p {project} -i {bug_id} -w scripts/tmp ... ")
+    start = time.perf_counter()
+    result = subprocess.run(
+        [str(t4p), "checkout", "-p", project, "-i", str(bug_id), "-w", str(tmp_dir)],
+        cwd=str(scripts_dir),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True
+    )
+    wall_time = round(time.perf_counter() - start, 2)
+
+    num_files = ""
+    shared_bytes = ""
+    if result.returncode == 0 and checkout_dir.exists():
+        status = "done"
+        num_files = count_files(checkout_dir)
+
+        if storage == "hardlink":
+            shared_bytes = dedupe_checkout(checkout_dir, tmp_dir / STORE_DIR / project)
+
+        (checkout_dir / MARKER_FILE).write_text(
+            json.dumps({"program_name": program_name, "num_files": num_files, "storage": storage}), encoding="utf-8"
+        )
+        print(f"SUCCESS: CHECKED OUT {program_name} ({wall_time}s) ...")
+    else:
+        status = "failed"
+        print(f"**ERROR: FAILED TO CHECK OUT {program_name} (return code {result.returncode}):")
+        print("\n".join(result.stdout.splitlines()[-10:]))
+
+    return {
+        "program_name": program_name,
+        "status": status,
+        "returncode": result.returncode,
+        "wall_time": wall_time,
+        "num_files": num_files,
+        "shared_bytes": shared_bytes,
+        "finished_at": datetime.now().isoformat(timespec="seconds")
+    }
+
+# Retrieve all chosen project(s) by using t4p checkout, running up to `jobs` checkouts at the same time
+def t4p_checkout(chosen_projects, t4p, tmp_dir, scripts_dir, jobs, storage="copy", force=False, verify=False):
+    manifest_path = tmp_dir / MANIFEST_FILE
+    manifest = read_manifest(manifest_path)
+
+    pending = []
+    unknown = 0
     for project, num_bugs in chosen_projects.items():
         for bug_id in range(1, num_bugs+1):
-            print(f"RUNNING: t4p checkout -p {project} -i {bug_id} -w scripts/tmp ... ")
+            program_name = f"{project}_{bug_id}"
+            checkout_dir = tmp_dir / program_name
+
+            if not force and is_checked_out(checkout_dir, verify):
+                print(f"SKIPPING: {program_name} IS ALREADY CHECKED OUT ...")
+                manifest.setdefault(program_name, {
+                    "program_name": program_name, "status": "done", "returncode": 0,
+                    "wall_time": "", "num_files": "", "shared_bytes": "", "finished_at": ""
+                })
 
-            subprocess.run(
-                [str(t4p), "checkout", "-p", project, "-i", str(bug_id), "-w", str(tmp_dir)],
-                cwd=str(scripts_dir)
-            )
+                # Move checkouts made in copy mode into the store when switching to hardlink mode
+                marker = read_marker(checkout_dir)
+                if storage == "hardlink" and marker.get("storage") != "hardlink":
+                    manifest[program_name]["shared_bytes"] = dedupe_checkout(checkout_dir, tmp_dir / STORE_DIR / project)
+                    marker["storage"] = storage
+                    (checkout_dir / MARKER_FILE).write_text(json.dumps(marker), encoding="utf-8")
+                continue
 
-# Retrieve Tests4Py project(s) by running t4p checkout. 
+            # Only directories this script started a checkout in are deleted and checked out again: anything else (e.g.
+            # a checkout made before the marker existed, with its LLM test files) is left alone unless --force is given
+            started = manifest.get(program_name, {}).get("status") in ["running", "failed"]
+            if checkout_dir.exists() and not force and not started:
+                print(f"**ERROR: {program_name} EXISTS BUT WAS NOT CHECKED OUT BY THIS SCRIPT, SKIPPING (use --force to check it out again) ...")
+                unknown += 1
+                continue
+            pending.append((project, bug_id))
+
+    # Record the checkouts that are about to start, so that their directories can be cleaned up after an interruption
+    for project, bug_id in pending:
+        program_name = f"{project}_{bug_id}"
+        manifest[program_name] = dict(manifest.get(program_name, {}), program_name=program_name, status="running")
+    write_manifest(manifest_path, manifest)
+
+    print(f"CHECKOUTS TO RUN: {len(pending)} (jobs={jobs})")
+    failed = 0
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [
+            pool.submit(checkout_bug, project, bug_id, t4p, tmp_dir, scripts_dir, storage)
+            for project, bug_id in pending
+        ]
+
+        # Update the manifest as soon as each checkout finishes so that an interrupted run can be resumed
+        for future in as_completed(futures):
+            row = future.result()
+            manifest[row["program_name"]] = row
+            failed += row["status"] == "failed"
+            write_manifest(manifest_path, manifest)
+
+    write_manifest(manifest_path, manifest)
+    print(f"FINISHED: {len(pending) - failed} CHECKED OUT, {failed} FAILED, {unknown} SKIPPED (see {manifest_path})")
+
+# Retrieve Tests4Py project(s) by running t4p checkout.
 def main():
     parser = argparse.ArgumentParser(description = "set up the experiment by installing all Tests4Py projects and their buggy versions.")
 
@@ -60,15 +276,44 @@ def main():
         help="checkout a single project."
     )
 
+    parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=4,
+        help="number of checkouts to run at the same time."
+    )
+
+    parser.add_argument(
+        "-s", "--storage",
+        choices=["copy", "hardlink"],
+        default="copy",
+        help="copy = a full tree per buggy version, hardlink = share identical files through one store per project."
+    )
+
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="checkout again even if a buggy version was already checked out (or its directory wasn't made by this script)."
+    )
+
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="also check that the files of completed checkouts are still intact before skipping them."
+    )
+
     args = parser.parse_args()
+    if args.jobs < 1:
+        sys.exit("Invalid -j. Use 1 or more jobs.")
+
     scripts_dir = Path(__file__).absolute().parent
     t4p = scripts_dir.parent /".venv" / "Scripts" / "t4p.exe"
 
     # Create tmp dir in scripts dir to store Tests4Py projects
     tmp_dir = scripts_dir / "tmp"
     tmp_dir.mkdir(exist_ok=True)
-     
+
     chosen_projects = select_projects(args.project)
-    t4p_checkout(chosen_projects, t4p, tmp_dir, scripts_dir)
+    t4p_checkout(chosen_projects, t4p, tmp_dir, scripts_dir, args.jobs, args.storage, args.force, args.verify)
 
-main()
\ No newline at end of file
+main()
@@ -2,7 +2,14 @@ import argparse
 from pathlib import Path
 import sys
 import subprocess
+import hashlib
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pandas as pd
+import venv_pool
+import coverage_store
+import sandbox
 
 PROJECTS = {
     "ansible": 18,
@@ -53,6 +60,36 @@ TEST_FILES = {
     "youtubedl": "test/test_age_restriction.py"
 }
 
+# A corresponding chosen "class under test" (CUT) file of each test file (see p03_generate_llm_tests.py)
+CUT_FILES = {
+    "ansible": "lib/ansible/errors/__init__.py",
+    "black": "black.py", 
+    "calculator": "src/calc/__init__.py", 
+    "cookiecutter": "cookiecutter/generate.py", 
+    "expression": "src/expression/expr/arithmetic.py", 
+    "fastapi": "fastapi/encoders.py", 
+    "httpie": "httpie/cli.py", 
+    "keras": "keras/losses.py", 
+    "luigi": "luigi/interface.py", 
+    "markup": "src/markup/__init__.py", 
+    "matplotlib": "lib/matplotlib/container.py", 
+    "middle": "src/middle/__init__.py", 
+    "pandas": "pandas/core/indexes/numeric.py", 
+    "pysnooper": "pysnooper/tracer.py", 
+    "sanic": "sanic/app.py", 
+    "scrapy": "scrapy/commands/fetch.py", 
+    "spacy": "spacy/util.py", 
+    "thefuck": "thefuck/logs.py", 
+    "tornado": "tornado/escape.py", 
+    "tqdm": "tqdm/_tqdm.py",
+    "youtubedl": "youtube_dl/YoutubeDL.py"
+}
+
+# Reasons why a trial isn't usable for the experiment
+UNUSABLE_INSTALL = "install"            # the project's packages can't be installed
+UNUSABLE_NO_COVERAGE = "no_coverage"    # pytest ran, but coverage couldn't be collected
+# (a run stopped by the sandbox records its exec status instead: timeout, cpu_time, memory or crashed)
+
 # Create CSV file if it doesn't exist, or read results.csv
 def read_csv(file_path):
     if not file_path.exists():
@@ -68,7 +105,8 @@ def read_csv(file_path):
             "coverage_delta",
             "kept",
             "discard_reason",
-            "prompt_mode"
+            "prompt_mode",
+            "unusable_reason"
         ])
         df.to_csv(file_path, index=False)
     return pd.read_csv(file_path)
@@ -83,13 +121,102 @@ def select_projects(project):
         chosen_projects = PROJECTS
     return chosen_projects
 
-# Parse the coverage report output to get the statement coverage number only
-def get_coverage_number(result2):
-    for line in result2.stdout.splitlines():
-        line = line.strip()
+# Source files that a baseline measures: every Python file of the CUT's package (package and cut scope, which trace the
+# whole package) or of the checkout (all scope), plus the test file and the conftest.py files it uses
+def measured_files(project, project_dir, scope):
+    if scope == "all":
+        root = project_dir
+    else:
+        root = project_dir / coverage_store.cut_package(project_dir, CUT_FILES[project])
+        if not root.is_dir():
+            root = project_dir / CUT_FILES[project]
+
+    files = sorted(path for path in root.rglob("*.py") if ".git" not in path.parts) if root.is_dir() else [root]
+    test_file = project_dir / TEST_FILES[project]
+    files += [test_file] + [parent / "conftest.py" for parent in test_file.parents if project_dir in parent.parents or parent == project_dir]
+    return files
+
+# Hash the measured source files, the environment, the coverage scope and the coveragerc of a trial (trials with the same
+# hash have the same baseline, including its line sets)
+def baseline_cache_key(project, project_dir, env_id, scope):
+    digest = hashlib.sha256(env_id.encode())
+    digest.update(f"scope:{scope}".encode())
+    digest.update(coverage_store.coveragerc_text(project_dir, CUT_FILES[project], scope).encode())
+
+    for path in measured_files(project, project_dir, scope):
+        digest.update(path.relative_to(project_dir).as_posix().encode())
+        digest.update(path.read_bytes() if path.is_file() else b"")
+    return digest.hexdigest()
+
+# Results.csv row of a trial (usable only if its baseline coverage was collected)
+def make_row(project, program_name, coverage_before=None, unusable_reason=""):
+    return {
+        "program_name": program_name,
+        "test_file": Path(TEST_FILES[project]).name,
+        "usable": coverage_before is not None,
+        "llm_test_file": "",
+        "builds": "",
+        "passes": "",
+        "coverage_before": "" if coverage_before is None else int(coverage_before),
+        "coverage_after": "",
+        "coverage_delta": "",
+        "kept": "",
+        "discard_reason": "",
+        "prompt_mode": "",
+        "unusable_reason": unusable_reason
+    }
+
+# Number of trials to run at the same time: the requested jobs, limited by the memory budget per trial
+def job_budget(jobs, mem_per_job):
+    if mem_per_job and hasattr(os, "sysconf") and "SC_AVPHYS_PAGES" in os.sysconf_names:
+        available_gb = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") / 1024**3
+        jobs = min(jobs, max(1, int(available_gb // mem_per_job)))
+    return jobs
+
+# Get the baseline coverage of a single trial (runs in a worker thread). Also returns how long the coverage run took,
+# and with --overhead how long the same run took without coverage
+def run_trial(trial, args):
+    python = trial["python"]
+    if python is None:
+        python = venv_pool.get_python(trial["project"], trial["project_dir"], args.offline)
+    if python is None:
+        return None, None, UNUSABLE_INSTALL, None
+
+    test_file = trial["project_dir"] / TEST_FILES[trial["project"]]
+    limits = sandbox.limits_from_args(args)
+    result2, files, status, seconds = coverage_store.pytest_coverage(
+        python, trial["project_dir"], [test_file], limits=limits, cut_file=CUT_FILES[trial["project"]], scope=args.cov_scope
+    )
+    timing = {"coverage": seconds, "plain": None, "core": coverage_store.coverage_env(python).get("COVERAGE_CORE", "default")}
+
+    if status != sandbox.OK:
+        return result2, None, status, None
+    if files is None:
+        return result2, None, UNUSABLE_NO_COVERAGE, None
 
-        if line.startswith("TOTAL"):
-            return line.split()[-1].replace("%", "")
+    if args.overhead:
+        start = time.perf_counter()
+        sandbox.run([str(python), "-m", "pytest", str(test_file)], trial["project_dir"], limits, stderr=subprocess.PIPE)
+        timing["plain"] = time.perf_counter() - start
+    return result2, files, "", timing
+
+# Traced lines and tracing overhead of the baselines that ran, per project
+def tracing_report(tracing):
+    rows = []
+    for project, runs in tracing.items():
+        plain = [run["plain"] for run in runs if run["plain"]]
+        coverage = sum(run["coverage"] for run in runs if run["plain"])
+        rows.append({
+            "Project": project,
+            "Baselines": len(runs),
+            "Core": runs[0]["core"],
+            "Traced files": round(sum(run["files"] for run in runs) / len(runs), 1),
+            "Traced statements": round(sum(run["statements"] for run in runs) / len(runs), 1),
+            "Coverage run (s)": round(sum(run["coverage"] for run in runs) / len(runs), 2),
+            "Plain run (s)": round(sum(plain) / len(plain), 2) if plain else None,
+            "Overhead": f"{coverage / sum(plain):.2f}x" if plain else None,
+        })
+    return pd.DataFrame(rows)
 
 # Run a test file of Tests4Py projects with pytest to record statement coverage
 def main():
@@ -100,6 +227,49 @@ def main():
         help="get statment coverage for a single project."
     )
 
+    parser.add_argument(
+        "-e", "--env",
+        choices=["venv", "system"],
+        default="venv",
+        help="venv = run each project in its own pooled virtual environment, system = install into this interpreter."
+    )
+
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="build virtual environments from the local wheel cache only."
+    )
+
+    parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="number of baselines to run at the same time (default: number of CPU cores)."
+    )
+
+    parser.add_argument(
+        "--mem-per-job",
+        type=float,
+        default=0,
+        help="expected memory use of one baseline in GB; limits --jobs to the available memory."
+    )
+
+    sandbox.add_arguments(parser, 900)
+
+    coverage_store.add_scope_argument(parser)
+
+    parser.add_argument(
+        "--overhead",
+        action="store_true",
+        help="also run every baseline without coverage to report the tracing overhead per project."
+    )
+
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="run the test file even if an identical buggy version already has a stored baseline."
+    )
+
     args = parser.parse_args()
     scripts_dir = Path(__file__).absolute().parent
     tmp_dir = scripts_dir / "tmp"
@@ -112,89 +282,122 @@ def main():
     file_path = results_dir / "results.csv" 
     df = read_csv(file_path)
     chosen_projects = select_projects(args.project)
-    
-    # Run pytest --cov --cov-report=term on all chosen projects to record coverage to results.csv
+    conn = coverage_store.connect()
+
+    trials = []
     for project, num_bugs in chosen_projects.items():
         for bug_id in range(1, num_bugs + 1):
             program_name = f"{project}_{bug_id}"
             project_dir = tmp_dir / f"{project}_{bug_id}"
 
-            # Attempt to install the project's packages (only run on first buggy version) to ensure that it is compatible
             print(f"CHECKING IF {project}_{bug_id} IS USABLE ... ")
-            if bug_id == 1:
-                result = subprocess.run(
-                    [python, "-m", "pip", "install", "-e", "."],
-                    cwd=str(project_dir)
-                )
-
-            if result.returncode == 0:
-                print("SUCCESS: PROJECT COMPATIBLE! ATTEMPTING TO GET COVERAGE ...")
-                test_file = project_dir / TEST_FILES[project]
-                
-                result2 = subprocess.run(
-                    [python, "-m", "pytest", str(test_file), "--cov", "--cov-report=term"],
-                    cwd=str(project_dir),
-                    stdout=subprocess.PIPE,
-                    text=True
-                )
-
-                print("PRINTING STATEMENT COVERAGE ...")
+            if args.env == "system":
+                # Attempt to install the project's packages (only run on first buggy version) to ensure that it is compatible
+                if bug_id == 1:
+                    result = subprocess.run(
+                        [python, "-m", "pip", "install", "-e", "."],
+                        cwd=str(project_dir)
+                    )
+                trial_python = python if result.returncode == 0 else None
+                env_id = f"system:{python}"
+
+            else:
+                # The virtual environment shared by buggy versions with the same dependencies is built by the worker
+                trial_python = None
+                env_id = venv_pool.env_key(project, project_dir)
+
+            trials.append({
+                "project": project,
+                "program_name": program_name,
+                "project_dir": project_dir,
+                "python": trial_python,
+                "installed": args.env == "venv" or trial_python is not None,
+                "cache_key": baseline_cache_key(project, project_dir, env_id, args.cov_scope)
+            })
+
+    # Only the first of several identical trials (same measured files, environment and scope) runs pytest,
+    # and trials whose baseline was already stored by an earlier run don't run at all
+    outcomes = {}
+    to_run = []
+    first_of_cache_key = {}
+    for trial in trials:
+        if not trial["installed"]:
+            outcomes[trial["program_name"]] = (None, UNUSABLE_INSTALL)
+        elif args.no_cache:
+            to_run.append(trial)
+        elif trial["cache_key"] not in first_of_cache_key:
+            first_of_cache_key[trial["cache_key"]] = trial["program_name"]
+            if coverage_store.find_cached(conn, trial["cache_key"]) is None:
+                to_run.append(trial)
+
+    jobs = job_budget(args.jobs, args.mem_per_job)
+    print(f"RUNNING {len(to_run)} OF {len(trials)} BASELINES (jobs={jobs}, timeout={args.timeout}s) ...")
+
+    # Run pytest --cov on the remaining trials in parallel, storing results as they finish
+    tracing = {}
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(run_trial, trial, args): trial for trial in to_run}
+
+        for future in as_completed(futures):
+            trial = futures[future]
+            program_name = trial["program_name"]
+            result2, files, unusable_reason, timing = future.result()
+
+            print(f"\n[{program_name}] PRINTING STATEMENT COVERAGE ...")
+            if result2 is not None:
                 print(result2.stdout)
-                coverage_before = get_coverage_number(result2)
-                    
-                # If pytest or other errors has occurred, then project isn't usable for experiment
-                if coverage_before is None:
-                    new_row = {
-                        "program_name": program_name,
-                        "test_file": Path(TEST_FILES[project]).name,
-                        "usable": False,
-                        "llm_test_file": "",
-                        "builds": "",
-                        "passes": "",
-                        "coverage_before": "",
-                        "coverage_after": "",
-                        "coverage_delta": "",
-                        "kept": "",
-                        "discard_reason": "",
-                        "prompt_mode": ""
-                    }
-                    print("ERROR: CANNOT COLLECT COVERAGE ...")
-
-                # If pytest ran successfully, then project can be used for experiment as a trial
-                else:
-                    new_row = {
-                        "program_name": program_name,
-                        "test_file": Path(TEST_FILES[project]).name,
-                        "usable": True,
-                        "llm_test_file": "",
-                        "builds": "",
-                        "passes": "",
-                        "coverage_before": int(coverage_before),
-                        "coverage_after": "",
-                        "coverage_delta": "",
-                        "kept": "",
-                        "discard_reason": "",
-                        "prompt_mode": ""
-                    }
-                    print("SUCCESS: COVERAGE COLLECTED ...")
-
-            # If pip install -e fails when installing packages because of incompatibility
+
+            coverage_before = None
+            if files is not None:
+                # Keep the covered lines of the baseline so that later questions don't require running it again
+                key = coverage_store.trial_key("baseline", program_name)
+                coverage_before = coverage_store.save_trial(conn, key, program_name, [TEST_FILES[trial["project"]]], files, args.cov_scope)
+                coverage_store.save_cached(conn, trial["cache_key"], key)
+                print(f"SUCCESS: COVERAGE COLLECTED FOR {program_name} ...")
+
+                _, num_statements, _ = coverage_store.totals(files)
+                tracing.setdefault(trial["project"], []).append({"files": len(files), "statements": num_statements, **timing})
+            elif unusable_reason == sandbox.TIMEOUT:
+                print(f"ERROR: {program_name} TIMED OUT AFTER {args.timeout}s ...")
+            elif unusable_reason == UNUSABLE_INSTALL:
+                print(f"ERROR: CANNOT INSTALL {program_name} ...")
+            elif unusable_reason != UNUSABLE_NO_COVERAGE:
+                print(f"ERROR: {program_name} STOPPED BY THE SANDBOX ({unusable_reason}) ...")
             else:
-                new_row = {
-                    "program_name": program_name,
-                    "test_file": Path(TEST_FILES[project]).name,
-                    "usable": False,
-                    "llm_test_file": "",
-                    "builds": "",
-                    "passes": "",
-                    "coverage_before": "",
-                    "coverage_after": "",
-                    "coverage_delta": "",
-                    "kept": "",
-                    "discard_reason": "",
-                    "prompt_mode": ""
-                }
-            df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
+                print(f"ERROR: CANNOT COLLECT COVERAGE FOR {program_name} ...")
+            outcomes[program_name] = (coverage_before, unusable_reason)
+
+    # Reuse the baseline of an earlier buggy version whose measured files, environment and scope are identical
+    for trial in trials:
+        program_name = trial["program_name"]
+        if program_name in outcomes:
+            continue
+
+        cached_key = coverage_store.find_cached(conn, trial["cache_key"])
+        if cached_key is None:
+            # The identical trial wasn't usable, so neither is this one
+            outcomes[program_name] = (None, outcomes[first_of_cache_key[trial["cache_key"]]][1])
+            continue
+
+        key = coverage_store.trial_key("baseline", program_name)
+        if cached_key == key:
+            print(f"BASELINE COVERAGE OF {program_name} IS ALREADY STORED ...")
+        else:
+            print(f"REUSING BASELINE COVERAGE OF {cached_key} FOR {program_name} (identical measured files, environment and scope) ...")
+        files = coverage_store.load_trial(conn, cached_key)
+        coverage_before = coverage_store.save_trial(conn, key, program_name, [TEST_FILES[trial["project"]]], files, args.cov_scope)
+        outcomes[program_name] = (coverage_before, "")
+
+    # Record every trial in results.csv (unusable trials keep the reason why: install, no_coverage or the exec status)
+    new_rows = [
+        make_row(trial["project"], trial["program_name"], *outcomes[trial["program_name"]])
+        for trial in trials
+    ]
+    df = pd.concat([df, pd.DataFrame(new_rows)], ignore_index=True)
     df.to_csv(file_path, index=False)
 
-main()
\ No newline at end of file
+    if tracing:
+        print(f"\nCOVERAGE TRACING PER PROJECT (scope={args.cov_scope}):")
+        print(tracing_report(tracing).to_string(index=False))
+
+main()
@@ -1,8 +1,15 @@
 import argparse
 from pathlib import Path
 import sys
+import asyncio
+import time
+import hashlib
+import re
+import os
 import pandas as pd
 import ollama
+import llm_cache
+import cut_slicer
 
 TEST_FILES = {
     "ansible": "test/units/errors/test_errors.py", 
@@ -58,6 +65,35 @@ LLMS = {
     "deepseek": "deepseek-coder:6.7b"
 }
 
+# Timing and token counts returned by Ollama with every response
+RESPONSE_METRICS = [
+    "prompt_eval_count",
+    "prompt_eval_duration",
+    "eval_count",
+    "eval_duration",
+    "load_duration",
+    "total_duration",
+]
+
+# Metrics recorded per trial (Ollama's metrics, the request latency in seconds, and whether the metrics were estimated
+# because a stream was stopped early)
+METRIC_COLUMNS = RESPONSE_METRICS + ["latency", "metrics_estimated"]
+
+# A fenced code block (```python ... ```) in a response (its language tag and source), and one that has been closed
+CODE_BLOCK = re.compile(r"```([^\n`]*)\n(.*?)(?:\n```|$)", re.DOTALL)
+CLOSED_CODE_BLOCK = re.compile(r"```([^\n`]*)\n(.*?)\n```", re.DOTALL)
+# Language tags of the code blocks that can hold the test class (untagged blocks included)
+PYTHON_TAGS = ["", "python", "python3", "py"]
+TEST_CODE = re.compile(r"^\s*(def test|class )", re.MULTILINE)
+
+# Prompt names used in the CSV and in the LLM test file names
+PROMPT_MODES = {
+    "1": "TESTONLY", # old name for the extend_test prompt (now EXTENDTEST)
+    "2": "TESTCUT", # old name for the extend_coverage prompt (now EXTENDCOV)
+    "3": "CORNERCASES",
+    "4": "STATEMENTCOMPLETE",
+}
+
 # Check if project input is valid
 def validate_project(project):
     if project:
@@ -76,6 +112,364 @@ def validate_model(model):
             "\n".join(sorted(LLMS.keys()))
         )   
 
+# Build the prompt of a trial. Prompts are directly from Meta's paper (see Table 2 in pg 7)
+def build_prompt(prompt_mode, existing_test_class, class_under_test):
+    # extend_test prompt
+    if (prompt_mode == "1"):
+        prompt = f"""
+            Here is a Python unit test class:
+
+            {existing_test_class}
+
+            Write an extended version of the test class that includes additional tests to cover some extra corner cases.
+            """
+
+    # extend_coverage prompt
+    elif (prompt_mode == "2"):
+        prompt = f"""
+            Here is a Python unit test class and the class that it tests:
+
+            {existing_test_class}
+            
+            {class_under_test}
+
+            Write an extended version of the test class that includes additional unit tests that will increase the test coverage of the class under test.
+            """
+
+    # corner_cases prompt
+    elif (prompt_mode == "3"):
+        prompt = f"""
+            Here is a Python unit test class and the class that it tests:
+
+            {existing_test_class}
+            
+            {class_under_test}
+
+            Write an extended version of the test class that includes additional unit tests that will cover corner cases missed by the original and will increase the test coverage of the class under test.
+            """
+
+    # statement_complete prompt
+    else:
+        prompt = f"""
+            Here is a Python class under test
+            
+            {class_under_test}
+            
+            This class under test can be tested with this Python unit test class 
+
+            {existing_test_class}
+
+            Here is an extended version of the unit test class that includes additional unit test cases that will cover methods, edge cases, corner cases, and other features of the class under test that were missed by the original unit test class:            
+            """
+    return prompt
+
+# Give every usable trial without an LLM test file one row per candidate (numbered in the sample column), so that each
+# candidate is built, run and measured as its own trial by the filters (only the trials selected by `mask`, e.g. those of
+# the project given with -p, are expanded)
+def expand_samples(df, samples, mask=True):
+    if "sample" not in df.columns:
+        df["sample"] = pd.NA
+    df["sample"] = df["sample"].astype("Int64")
+
+    pending = (df["usable"] == True) & df["llm_test_file"].isna() & df["sample"].isna() & mask
+    expanded = df.loc[df.index.repeat(pending.map({True: samples, False: 1}))]
+    candidates = expanded.groupby(level=0).cumcount().to_numpy()
+    is_pending = pending.loc[expanded.index].to_numpy()
+
+    expanded = expanded.reset_index(drop=True)
+    expanded.loc[is_pending, "sample"] = candidates[is_pending]
+    return expanded
+
+# Name of the LLM test file of a trial (candidates get a _s<number> suffix)
+def llm_test_name(original_test_file, model, mode, sample):
+    suffix = "" if pd.isna(sample) else f"_s{sample}"
+    return original_test_file.with_name(original_test_file.stem + "_" + model.upper() + "_" + mode + suffix + ".py")
+
+# Read the test class (and CUT) of every trial and build its prompt. Trials with missing files are skipped.
+# With a `cut_budget` (in tokens), the CUT is sliced to the code the test class uses before it goes into the prompt
+def plan_trials(df, df_usable, prompt_mode, tmp_dir, model, cut_budget=None):
+    mode = PROMPT_MODES[prompt_mode]
+    trials = []
+
+    for index, row in df_usable.iterrows():
+        # Get the program names in selected project (e.g. ansible_1, ansible_2, ...)
+        program_name = row["program_name"]
+        project = program_name.split("_")[0]
+
+        project_dir = tmp_dir / program_name
+        original_test_file = project_dir / TEST_FILES[project]
+
+        # Skip if test file can't be found so that program doesn't crash if running on all projects
+        try:
+            existing_test_class = original_test_file.read_text(encoding="utf-8")
+        except FileNotFoundError:
+            print(f"**ERROR: MISSING TEST FILE NAME FOR {program_name}, SKIPPING ...\n")
+            continue
+
+        # Every prompt except extend_test also includes the class under test
+        class_under_test = None
+        if prompt_mode != "1":
+            class_under_test_file = project_dir / CUT_FILES[project]
+
+            try:
+                class_under_test = class_under_test_file.read_text(encoding="utf-8")
+            except FileNotFoundError:
+                print(f"**ERROR: Missing CUT file for {program_name}, skipping...")
+                continue
+
+        # Record the prompt size (in characters) with the full CUT and with the sliced CUT
+        prompt = build_prompt(prompt_mode, existing_test_class, class_under_test)
+        prompt_size_original = len(prompt)
+        if cut_budget and class_under_test is not None:
+            class_under_test = cut_slicer.slice_cut(class_under_test, existing_test_class, cut_budget)
+            prompt = build_prompt(prompt_mode, existing_test_class, class_under_test)
+
+        df.loc[index, "prompt_mode"] = mode
+        df.loc[index, "prompt_size_original"] = prompt_size_original
+        df.loc[index, "prompt_size_reduced"] = len(prompt)
+
+        sample = row.get("sample", pd.NA)
+        trials.append({
+            "index": index,
+            "program_name": program_name,
+            "prompt": prompt,
+            "prompt_size_original": prompt_size_original,
+            "candidate": 0 if pd.isna(sample) else int(sample),
+            "output_file": llm_test_name(original_test_file, model, mode, sample),
+        })
+    return trials
+
+# Group trials with byte-identical prompts (e.g. buggy versions that share the test class and CUT) into one request,
+# or `class_samples` requests whose responses are spread over the group's trials. Candidates of a trial are separate
+# groups, and the requests for one prompt are kept next to each other so that the server can reuse the loaded prompt
+def plan_requests(trials, class_samples, dedupe):
+    groups = {}
+    for trial in trials:
+        group_key = hashlib.sha256(trial["prompt"].encode("utf-8")).hexdigest() if dedupe else trial["index"]
+        groups.setdefault((group_key, trial["candidate"]), []).append(trial)
+
+    requests = []
+    for (_, candidate), members in groups.items():
+        samples = min(class_samples, len(members))
+
+        for sample in range(samples):
+            requests.append({
+                "program_name": members[sample]["program_name"],
+                "prompt": members[0]["prompt"],
+                "candidate": candidate,
+                "sample": candidate * class_samples + sample,
+                "members": members[sample::samples],
+            })
+    return requests
+
+# Send requests in CSV order, or sorted by prompt so that prompts with the longest common prefix (e.g. the same test class
+# and CUT of different buggy versions) are sent one after another and the server can reuse the prompt it already evaluated
+def order_requests(requests, order):
+    if order == "prefix":
+        return sorted(requests, key=lambda request: request["prompt"])
+    return requests
+
+# Number of prompt characters shared with the prompt of the previous request
+def shared_prefix_chars(requests):
+    return sum(
+        len(os.path.commonprefix([previous["prompt"], request["prompt"]]))
+        for previous, request in zip(requests, requests[1:])
+    )
+
+# Prompt tokens per second of a model, measured by earlier model calls recorded in the CSV (None if there are none)
+def prompt_rate(df, model):
+    if "response_source" not in df.columns:
+        return None
+
+    # Estimated prompt-eval times also include model loads, so only complete metrics count
+    calls = df[(df["response_source"] == "model") & (df["llm_model"] == LLMS[model])]
+    if "metrics_estimated" in calls.columns:
+        calls = calls[calls["metrics_estimated"] != True]
+    seconds = calls["prompt_eval_duration"].sum() / 1e9
+    return calls["prompt_eval_count"].sum() / seconds if seconds else None
+
+# Report how much of the prompts the server can reuse from the previous request, compared to sending them in CSV order
+def report_prefix_reuse(df, requests, ordered_requests, order, model):
+    total = sum(len(request["prompt"]) for request in requests) // cut_slicer.CHARS_PER_TOKEN
+    reused_csv = shared_prefix_chars(requests) // cut_slicer.CHARS_PER_TOKEN
+    reused = shared_prefix_chars(ordered_requests) // cut_slicer.CHARS_PER_TOKEN
+    print(f"PROMPT PREFIX REUSE ({order.upper()} ORDER): ~{reused} OF ~{total} PROMPT TOKENS (CSV ORDER: ~{reused_csv})")
+
+    rate = prompt_rate(df, model)
+    if rate:
+        print(f"ESTIMATED PROMPT-EVAL TIME SAVED: {reused / rate:.1f}s ({(reused - reused_csv) / rate:.1f}s MORE THAN CSV ORDER) "
+              f"AT {rate:.0f} PROMPT TOKENS/S")
+
+# Options sent to the model for the n-th sample of a prompt (a different seed, if one is set, and the candidate's
+# temperature, if several are set), and the options that go into its cache key (the sample number keeps samples apart)
+def sample_options(options, sample, candidate=0, temperatures=None):
+    model_options = dict(options)
+    if temperatures:
+        model_options["temperature"] = temperatures[candidate % len(temperatures)]
+    if sample == 0:
+        return model_options, model_options
+
+    if "seed" in model_options:
+        model_options["seed"] += sample
+    return model_options, dict(model_options, sample=sample)
+
+# Whether a code block (language tag and source) is Python with a test function or class in it
+def is_test_block(tag, source):
+    return tag.strip().lower() in PYTHON_TAGS and TEST_CODE.search(source) is not None
+
+# Extract the Python source from a response: the longest fenced Python code block with tests (even if the response
+# stopped inside it), else the longest code block, or the whole response if it has no code block
+def extract_code(llm_response):
+    blocks = CODE_BLOCK.findall(llm_response)
+    if not blocks:
+        return llm_response
+    test_blocks = [block for block in blocks if is_test_block(*block)]
+    return max(test_blocks or blocks, key=lambda block: len(block[1]))[1].rstrip() + "\n"
+
+# Read a streamed response as it is generated, and stop early once a Python code block with tests has been closed (other
+# blocks, e.g. ```bash with install commands, don't stop it) or `max_seconds` have passed
+# (returns the text and the final chunk with Ollama's metrics. If the response was stopped early, the metrics are estimated
+# and marked as such: one response token per chunk, generated from the first chunk on, the prompt's tokens from its size,
+# evaluated until the first chunk arrived. The time of a model load can't be told apart from that, so it counts as
+# prompt evaluation)
+async def stream_chat(client, model, messages, options, max_seconds, keep_alive=None):
+    start = time.perf_counter()
+    first_chunk = None
+    parts = []
+    final_chunk = {}
+
+    stream = await client.chat(model=LLMS[model], messages=messages, options=options, stream=True, keep_alive=keep_alive)
+    try:
+        async for chunk in stream:
+            parts.append(chunk["message"]["content"])
+            if first_chunk is None:
+                first_chunk = time.perf_counter()
+
+            if chunk.get("done"):
+                final_chunk = chunk
+                break
+            if "`" in parts[-1] and any(is_test_block(*block) for block in CLOSED_CODE_BLOCK.findall("".join(parts))):
+                break
+            if max_seconds and time.perf_counter() - start > max_seconds:
+                break
+    finally:
+        # Closing the stream closes the connection, which stops the generation on the server
+        await stream.aclose()
+
+    if not final_chunk and first_chunk is not None:
+        end = time.perf_counter()
+        final_chunk = {
+            "prompt_eval_count": sum(len(message["content"]) for message in messages) // cut_slicer.CHARS_PER_TOKEN,
+            "prompt_eval_duration": int((first_chunk - start) * 1e9),
+            "eval_count": len(parts),
+            "eval_duration": int((end - first_chunk) * 1e9),
+            "load_duration": 0,
+            "total_duration": int((end - start) * 1e9),
+            "estimated": True,
+        }
+    return "".join(parts), final_chunk
+
+# Prompt the selected LLM to generate an extended test class (at most `concurrency` requests are sent at the same time).
+# Responses are looked up in and stored to the response cache depending on the cache mode
+async def generate(client, semaphore, cache, model, options, sampling, stream, request):
+    model_options, cache_options = sample_options(options, request["sample"], request["candidate"], sampling["temperatures"])
+
+    # A streamed response may be cut short, so the stream settings are part of its cache key
+    if stream is not None:
+        cache_options = dict(cache_options, stream=stream)
+    key = llm_cache.make_key(LLMS[model], request["prompt"], cache_options)
+
+    if cache["mode"] in ("read", "write"):
+        cached = llm_cache.get(cache["conn"], key)
+        if cached is not None:
+            print(f"USING CACHED RESPONSE FOR {request['program_name']} ...")
+            cache["hits"] += 1
+            return request, cached[0], cached[1], "cache"
+
+    # Read mode never calls the model: a trial without a cached response is left without an LLM test file
+    if cache["mode"] == "read":
+        print(f"SKIPPING: NO CACHED RESPONSE FOR {request['program_name']} ...")
+        cache["misses"] += 1
+        return request, None, None, None
+
+    async with semaphore:
+        print(f"GENERATING EXTENDED TEST FOR {request['program_name']} ...")
+
+        messages = [
+            {
+                "role": "user",
+                "content": request["prompt"],
+            },
+        ]
+
+        try:
+            start = time.perf_counter()
+            if stream is not None:
+                llm_response, response = await stream_chat(client, model, messages, model_options, stream["max_seconds"], sampling["keep_alive"])
+            else:
+                response = await client.chat(
+                    model=LLMS[model], messages=messages, options=model_options, keep_alive=sampling["keep_alive"]
+                )
+                llm_response = response["message"]["content"]
+            cache["calls"] += 1
+
+        except Exception as e:
+            print(f"**ERROR: FAILED TO GENERATE FOR {request['program_name']}: {e} ...\n")
+            return request, None, None, None
+
+    metadata = {name: response.get(name) for name in RESPONSE_METRICS}
+    metadata["latency"] = round(time.perf_counter() - start, 3)
+    metadata["metrics_estimated"] = bool(response.get("estimated"))
+    if cache["mode"] in ("write", "refresh"):
+        llm_cache.put(cache["conn"], key, LLMS[model], llm_response, metadata, cache["max_bytes"])
+    return request, llm_response, metadata, "model"
+
+# Write each generated test class to a file in the same directory as the original test class and record it in the CSV
+# with the model's timing and token metrics, separately from the requests so that the model never waits for the disk
+async def record_results(queue, df, results_csv, model, extract):
+    while True:
+        request, llm_response, metadata, source = await queue.get()
+
+        # An error only loses this request's results: the item is always marked as done, so queue.join() still returns
+        try:
+            # The response of a request is used by every trial with the same prompt
+            if llm_response is not None:
+                if extract:
+                    llm_response = extract_code(llm_response)
+
+                for member, trial in enumerate(request["members"]):
+                    output_file = trial["output_file"]
+                    await asyncio.to_thread(output_file.write_text, llm_response, encoding="utf-8")
+
+                    print(f"SUCCESS: GENERATED TEST FOR {trial['program_name']} ...\n\t--> {output_file}\n")
+                    df.loc[trial["index"], "llm_test_file"] = output_file.name
+
+                    # Only the first trial of a request is counted as a model call (the others share its response)
+                    df.loc[trial["index"], "llm_model"] = LLMS[model]
+                    df.loc[trial["index"], "response_source"] = source if member == 0 else "shared"
+                    for name in METRIC_COLUMNS:
+                        df.loc[trial["index"], name] = metadata.get(name)
+                await asyncio.to_thread(df.to_csv, results_csv, index=False)
+        except Exception as error:
+            names = ", ".join(trial["program_name"] for trial in request["members"])
+            print(f"**ERROR: FAILED TO RECORD THE RESPONSE FOR {names}: {error}")
+        finally:
+            queue.task_done()
+
+# Send all requests, keeping up to `concurrency` requests in flight
+async def generate_all(requests, df, results_csv, model, options, sampling, stream, concurrency, cache):
+    client = ollama.AsyncClient()
+    semaphore = asyncio.Semaphore(concurrency)
+    queue = asyncio.Queue()
+    writer = asyncio.create_task(record_results(queue, df, results_csv, model, extract=stream is not None))
+
+    async def generate_and_queue(request):
+        await queue.put(await generate(client, semaphore, cache, model, options, sampling, stream, request))
+
+    await asyncio.gather(*(generate_and_queue(request) for request in requests))
+    await queue.join()
+    writer.cancel()
+
 # Prompt an LLM to generate an extended test class file and output it into the same path as the original test class
 def main():
     parser = argparse.ArgumentParser(description = "generate an LLM extended test class using the selected model and prompt, and save it to the same path as the original test class.")
@@ -102,6 +496,111 @@ def main():
         default="results.csv",
         help="CSV filename in results directory that records the data."
     )
+
+    parser.add_argument(
+        "-c", "--concurrency",
+        type=int,
+        default=1,
+        help="number of generation requests sent to the model server at the same time."
+    )
+
+    parser.add_argument(
+        "--temperature",
+        type=float,
+        help="sampling temperature passed to the model (default: the model's own setting)."
+    )
+
+    parser.add_argument(
+        "--seed",
+        type=int,
+        help="sampling seed passed to the model (default: random)."
+    )
+
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="stream responses, stop once the code block is closed (or at --max-seconds), and write only the extracted Python source."
+    )
+
+    parser.add_argument(
+        "--max-tokens",
+        type=int,
+        help="maximum number of tokens the model may generate per response (Ollama's num_predict)."
+    )
+
+    parser.add_argument(
+        "--max-seconds",
+        type=float,
+        help="with --stream, stop reading a response after this many seconds."
+    )
+
+    parser.add_argument(
+        "--no-dedupe",
+        action="store_true",
+        help="send a request for every trial, even if other trials have a byte-identical prompt."
+    )
+
+    parser.add_argument(
+        "--class-samples",
+        type=int,
+        default=1,
+        help="number of different responses to generate for a group of trials with an identical prompt."
+    )
+
+    parser.add_argument(
+        "--samples",
+        type=int,
+        default=1,
+        help="number of candidate test classes to generate per trial (each candidate is filtered as its own trial)."
+    )
+
+    parser.add_argument(
+        "--temperatures",
+        type=float,
+        nargs="+",
+        help="sampling temperatures used in turn by the candidates of a trial (default: --temperature for every candidate)."
+    )
+
+    parser.add_argument(
+        "--keep-alive",
+        default="30m",
+        help="how long the model server keeps the model loaded after a request (e.g. 30m, or -1 to keep it loaded)."
+    )
+
+    parser.add_argument(
+        "--order",
+        choices=["prefix", "csv"],
+        default="prefix",
+        help="prefix = send prompts with a common prefix one after another so the server can reuse it, csv = CSV order."
+    )
+
+    parser.add_argument(
+        "--slice-cut",
+        action="store_true",
+        help="only put the CUT code used by the test class into the prompt (the rest as signatures and docstrings)."
+    )
+
+    parser.add_argument(
+        "--cut-budget",
+        type=int,
+        default=6000,
+        help="with --slice-cut, approximate maximum number of tokens of the sliced CUT."
+    )
+
+    parser.add_argument(
+        "--cache-mode",
+        choices=llm_cache.CACHE_MODES,
+        default="write",
+        help="read = only use cached responses (trials without one are skipped, the model is never called), write = use cached responses and store new ones, "
+             "off = don't use the response cache, refresh = replace cached responses with new ones."
+    )
+
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=1024,
+        help="maximum size of the response cache in MB (least recently used responses are evicted first)."
+    )
     
     args = parser.parse_args()
     validate_project(args.project)
@@ -115,8 +614,14 @@ def main():
     # Read results.csv and iterate through 'usable' projects only (projects that have baseline coverage recorded)
     df = pd.read_csv(results_csv)
     df["llm_test_file"] = df["llm_test_file"].astype("string")
+    if args.samples > 1:
+        selected = df["program_name"].str.startswith(args.project + "_") if args.project else True
+        df = expand_samples(df, args.samples, selected)
     df_usable = df[(df["usable"] == True) & df["llm_test_file"].isna()]
     df["prompt_mode"] = df["prompt_mode"].astype("string")
+    for name in ["llm_model", "response_source"]:
+        if name in df.columns:
+            df[name] = df[name].astype("string")
 
     # Select a single project only
     if args.project:
@@ -124,141 +629,61 @@ def main():
 
     print(f"MODEL: {LLMS[args.model]}")
     
-    # Prompts are directly from Meta's paper (see Table 2 in pg 7)
     prompt_mode = str(args.number)
-    if prompt_mode == "1":
-        mode = "TESTONLY" # old name for the extend_test prompt (now EXTENDTEST)
-    elif prompt_mode == "2":
-        mode = "TESTCUT" # old name for the extend_coverage prompt (now EXTENDCOV)
-    elif prompt_mode == "3":
-        mode = "CORNERCASES"
-    elif prompt_mode == "4":
-        mode = "STATEMENTCOMPLETE"
-    else:
+    if prompt_mode not in PROMPT_MODES:
         sys.exit("Invalid -n. Use 1, 2, 3, or 4.")
+    if args.concurrency < 1:
+        sys.exit("Invalid -c. Use 1 or more requests.")
+    if args.class_samples < 1:
+        sys.exit("Invalid --class-samples. Use 1 or more samples.")
+    if args.samples < 1:
+        sys.exit("Invalid --samples. Use 1 or more candidates.")
+    if args.cut_budget < 1:
+        sys.exit("Invalid --cut-budget. Use 1 or more tokens.")
         
-    print(f"PROMPT MODE: {mode}")
+    print(f"PROMPT MODE: {PROMPT_MODES[prompt_mode]}")
     print(f"CSV FILE: {args.file}")
 
-    for index, row in df_usable.iterrows():
-        # Get the program names in selected project (e.g. ansible_1, ansible_2, ...)
-        program_name = row["program_name"]
-        project = program_name.split("_")[0]
+    # Sampling options are part of the response cache key, so only the ones set by the user are sent
+    options = {}
+    if args.temperature is not None:
+        options["temperature"] = args.temperature
+    if args.seed is not None:
+        options["seed"] = args.seed
+    if args.max_tokens is not None:
+        options["num_predict"] = args.max_tokens
 
-        project_dir = tmp_dir / program_name
-        original_test_file = project_dir / TEST_FILES[project]
-        
-        # Skip if test file can't be found so that program doesn't crash if running on all projects
-        try:
-            existing_test_class = original_test_file.read_text(encoding="utf-8")
-        except FileNotFoundError:
-            print(f"**ERROR: MISSING TEST FILE NAME FOR {program_name}, SKIPPING ...\n")
-            continue
-        
-        # extend_test prompt
-        if (prompt_mode == "1"):
-            df.loc[df["program_name"] == program_name, "prompt_mode"] = mode
-            
-            prompt = f"""
-            Here is a Python unit test class:
+    stream = {"max_seconds": args.max_seconds} if args.stream else None
 
-            {existing_test_class}
+    cache = {
+        "mode": args.cache_mode,
+        "conn": None if args.cache_mode == "off" else llm_cache.connect(),
+        "max_bytes": args.cache_size * 1024 * 1024,
+        "hits": 0,
+        "misses": 0,
+        "calls": 0,
+    }
 
-            Write an extended version of the test class that includes additional tests to cover some extra corner cases.
-            """
-    
-        # extend_coverage prompt
-        elif (prompt_mode == "2"):
-            class_under_test_file = project_dir / CUT_FILES[project]
-            
-            try:
-                class_under_test = class_under_test_file.read_text(encoding="utf-8")
-            except FileNotFoundError:
-                print(f"**ERROR: Missing CUT file for {program_name}, skipping...")
-                continue
-
-            df.loc[df["program_name"] == program_name, "prompt_mode"] = mode
-            
-            prompt = f"""
-            Here is a Python unit test class and the class that it tests:
-
-            {existing_test_class}
-            
-            {class_under_test}
-
-            Write an extended version of the test class that includes additional unit tests that will increase the test coverage of the class under test.
-            """
-        
-        # corner_cases prompt    
-        elif (prompt_mode == "3"):
-            class_under_test_file = project_dir / CUT_FILES[project]
+    # Settings that differ between the candidates of a trial or don't change the response (so they are not in the cache key)
+    sampling = {
+        "temperatures": args.temperatures,
+        "keep_alive": int(args.keep_alive) if args.keep_alive.lstrip("-").isdigit() else args.keep_alive,
+    }
 
-            try:
-                class_under_test = class_under_test_file.read_text(encoding="utf-8")
-            except FileNotFoundError:
-                print(f"**ERROR: Missing CUT file for {program_name}, skipping...")
-                continue
-            
-            df.loc[df["program_name"] == program_name, "prompt_mode"] = mode
-            
-            prompt = f"""
-            Here is a Python unit test class and the class that it tests:
+    cut_budget = args.cut_budget if args.slice_cut else None
+    trials = plan_trials(df, df_usable, prompt_mode, tmp_dir, args.model, cut_budget)
+    if cut_budget and trials:
+        original = sum(trial["prompt_size_original"] for trial in trials)
+        reduced = sum(len(trial["prompt"]) for trial in trials)
+        print(f"CUT SLICING: PROMPTS REDUCED FROM {original} TO {reduced} CHARACTERS")
+    requests = plan_requests(trials, args.class_samples, not args.no_dedupe)
+    print(f"TRIALS: {len(trials)}, REQUESTS: {len(requests)} ({len(trials) - len(requests)} MODEL CALLS SAVED BY IDENTICAL PROMPTS)")
 
-            {existing_test_class}
-            
-            {class_under_test}
+    ordered_requests = order_requests(requests, args.order)
+    report_prefix_reuse(df, requests, ordered_requests, args.order, args.model)
+    requests = ordered_requests
 
-            Write an extended version of the test class that includes additional unit tests that will cover corner cases missed by the original and will increase the test coverage of the class under test.
-            """
-    
-        # statement_complete prompt
-        else:
-            class_under_test_file = project_dir / CUT_FILES[project]
-
-            try:
-                class_under_test = class_under_test_file.read_text(encoding="utf-8")
-            except FileNotFoundError:
-                print(f"**ERROR: Missing CUT file for {program_name}, skipping...")
-                continue
-            
-            df.loc[df["program_name"] == program_name, "prompt_mode"] = mode
-            
-            prompt = f"""
-            Here is a Python class under test
-            
-            {class_under_test}
-            
-            This class under test can be tested with this Python unit test class 
-
-            {existing_test_class}
-
-            Here is an extended version of the unit test class that includes additional unit test cases that will cover methods, edge cases, corner cases, and other features of the class under test that were missed by the original unit test class:            
-            """
-        
-        print(f"GENERATING EXTENDED TEST FOR {program_name} ...")
-        output_file = original_test_file.with_name(original_test_file.stem + "_" + args.model.upper() + "_" + mode + ".py")
-         
-        # Prompt the selected LLM to generate an extended test class
-        try:
-            response = ollama.chat(model=LLMS[args.model], messages=[
-                {
-                    "role": "user",
-                    "content": prompt,
-                },
-            ])
-                
-            llm_response = response["message"]["content"]               
-            print(f"SUCCESS: GENERATED TEST FOR {program_name} ...\n\t--> {output_file}\n")
-            
-        except Exception as e:
-            print(f"**ERROR: FAILED TO GENERATE FOR {program_name}: {e} ...\n")
-            continue
-            
-        # Output to file in same directory as the original test class
-        with open(output_file, "w", encoding="utf-8") as py_file:
-            py_file.write(llm_response)
-            
-        df.loc[df["program_name"] == program_name, "llm_test_file"] = output_file.name  
-        df.to_csv(results_csv, index=False)
+    asyncio.run(generate_all(requests, df, results_csv, args.model, options, sampling, stream, args.concurrency, cache))
+    print(f"MODEL CALLS: {cache['calls']}, CACHED RESPONSES USED: {cache['hits']}, SKIPPED (NOT CACHED): {cache['misses']}")
         
-main()
\ No newline at end of file
+main()
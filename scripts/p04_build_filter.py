@@ -2,7 +2,12 @@ import argparse
 from pathlib import Path
 import sys
 import pandas as pd
-import subprocess
+import ast
+import os
+import sysconfig
+import venv_pool
+import pytest_worker
+import sandbox
  
 TEST_FILES = {
     "ansible": "test/units/errors/test_errors.py", 
@@ -28,6 +33,9 @@ TEST_FILES = {
     "youtubedl": "test/test_age_restriction.py", 
 }
 
+# Top-level module names available to each interpreter (filled by installed_modules)
+INSTALLED_MODULES = {}
+
 # Check if project input is valid
 def validate_project(project):
     if project:
@@ -37,17 +45,131 @@ def validate_project(project):
                 "Available Tests4Py projects:\n" + "\n".join(sorted(TEST_FILES.keys()))
             )
 
+# Directories of the checkout that tests import from: the test file's directory and its parents (pytest puts the first
+# one without an __init__.py on sys.path), and the usual source directories
+def checkout_dirs(project_dir, llm_test_path):
+    dirs = [project_dir / "src", project_dir / "lib"]
+    directory = llm_test_path.parent
+    while directory != project_dir and project_dir in directory.parents:
+        dirs.append(directory)
+        directory = directory.parent
+    return dirs + [project_dir]
+
+# Top-level module names that can be imported from a directory (modules, packages and extension modules)
+def module_names(directory):
+    names = set()
+    try:
+        entries = list(os.scandir(directory))
+    except OSError:
+        return names
+
+    for entry in entries:
+        if entry.is_dir():
+            names.add(entry.name)
+        elif entry.name.endswith((".py", ".pyc", ".so", ".pyd")):
+            names.add(entry.name.split(".")[0])
+    return names
+
+# Top-level module names available to an interpreter: the standard library and its site-packages
+# (including directories added by .pth files, e.g. editable installs). Computed once per interpreter
+def installed_modules(python):
+    if python in INSTALLED_MODULES:
+        return INSTALLED_MODULES[python]
+
+    # The standard library's extension modules are in lib-dynload, or in DLLs on Windows (e.g. select, unicodedata)
+    names = set(sys.builtin_module_names) | set(getattr(sys, "stdlib_module_names", ()))
+    stdlib = Path(sysconfig.get_paths()["stdlib"])
+    platstdlib = Path(sysconfig.get_paths()["platstdlib"])
+    for directory in [stdlib, platstdlib, stdlib / "lib-dynload", platstdlib / "lib-dynload", Path(sys.base_prefix) / "DLLs"]:
+        names |= module_names(directory)
+
+    # Pooled environments share the driver's Python version, so only their site-packages differ
+    if Path(python) == Path(sys.executable):
+        site_dirs = [Path(path) for path in sys.path if path and Path(path) != stdlib]
+    else:
+        env_dir = Path(python).parent.parent
+        site_dirs = list(env_dir.glob("lib/python*/site-packages")) + list(env_dir.glob("Lib/site-packages"))
+
+    for site_dir in site_dirs:
+        names |= module_names(site_dir)
+        for pth_file in site_dir.glob("*.pth"):
+            for line in pth_file.read_text(encoding="utf-8", errors="ignore").splitlines():
+                if line and not line.startswith(("#", "import")):
+                    names |= module_names(site_dir / line.strip())
+
+    INSTALLED_MODULES[python] = names
+    return names
+
+# Module-level imports of a test file that must succeed for it to be collected (imports guarded by try/except are optional)
+def required_imports(tree):
+    modules = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            modules += [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            modules.append(node.module)
+    return modules
+
+# Check if a test file defines anything that pytest could collect (test functions, or test methods in classes). A class with
+# base classes may inherit its tests (e.g. `class TestExtended(TestMiddle): pass`), and imported test classes or functions
+# are collected too, so pytest decides for those
+def has_tests(tree):
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)) and node.name.startswith("test"):
+            return True
+        if isinstance(node, ast.ImportFrom) and any(alias.name.lower().startswith("test") for alias in node.names):
+            return True
+        if isinstance(node, ast.ClassDef):
+            if any(not (isinstance(base, ast.Name) and base.id == "object") for base in node.bases):
+                return True
+            for child in node.body:
+                if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef)) and child.name.startswith("test"):
+                    return True
+    return False
+
+# Cheap in-process checks of an LLM test file before pytest is started: it must be Python, its imports must be found in the
+# checkout or the environment, and it must contain tests (returns the reason it can't build, or None if it might build)
+def prefilter(llm_test_path, project_dir, python):
+    try:
+        source = llm_test_path.read_text(encoding="utf-8")
+        tree = ast.parse(source, filename=str(llm_test_path))
+        compile(tree, str(llm_test_path), "exec")
+    except (SyntaxError, ValueError, UnicodeDecodeError):
+        return "syntax"
+    except FileNotFoundError:
+        return "missing file"
+
+    available = installed_modules(str(python))
+    for directory in checkout_dirs(project_dir, llm_test_path):
+        available = available | module_names(directory)
+
+    for module in required_imports(tree):
+        if module.split(".")[0] not in available:
+            return f"missing import: {module}"
+
+    if not has_tests(tree):
+        return "no tests"
+    return None
+
+# Reason recorded for a failed pytest --collect-only run (pytest exits with 5 if it collected no tests)
+def collection_reason(result):
+    if result.returncode == 5:
+        return "no tests"
+    return "collection error"
+
 # Update builds column with either true or false, and update discard_reason column with 1 if build failed
-def record_result(df, program_name, result):
-    builds_bool = (result.returncode == 0)
-    df.loc[df["program_name"] == program_name, "builds"] = builds_bool
+# (build_reason records why: syntax, missing import, no tests, collection error, install (no environment) or the exec
+# status of a stopped run)
+def record_result(df, index, program_name, builds_bool, build_reason=""):
+    df.loc[index, "builds"] = builds_bool
+    df.loc[index, "build_reason"] = build_reason
 
     if not builds_bool:
-        df.loc[df["program_name"] == program_name, "discard_reason"] = 1
-        print("BUILD FAILED ...")
+        df.loc[index, "discard_reason"] = 1
+        print(f"BUILD FAILED ({build_reason}) ...")
         
     else:
-        df.loc[df["program_name"] == program_name, "discard_reason"] = pd.NA
+        df.loc[index, "discard_reason"] = pd.NA
         print("BUILD SUCCESS ...")
 
 # Apply TestGen-LLM's first filter, which is to check for build correctness 
@@ -67,6 +189,27 @@ def main():
         help="CSV filename in results directory that records the data.",
     )
 
+    parser.add_argument(
+        "-e", "--env",
+        choices=["venv", "system"],
+        default="venv",
+        help="venv = run tests in the project's pooled virtual environment, system = use this interpreter."
+    )
+
+    parser.add_argument(
+        "--no-prefilter",
+        action="store_true",
+        help="run pytest --collect-only on every file, without the in-process syntax, import and test checks first."
+    )
+
+    parser.add_argument(
+        "--worker",
+        action="store_true",
+        help="collect in a forked child of a worker that has pytest and the project imported already (not on Windows)."
+    )
+
+    sandbox.add_arguments(parser, 120)
+
     args = parser.parse_args()
     validate_project(args.project)
 
@@ -77,6 +220,9 @@ def main():
 
     # Read results.csv and iterate through 'usable' projects only
     df = pd.read_csv(results_csv)
+    df["build_reason"] = df.get("build_reason", pd.Series(pd.NA, index=df.index)).astype("string")
+    df["exec_status"] = df.get("exec_status", pd.Series(pd.NA, index=df.index)).astype("string")
+    limits = sandbox.limits_from_args(args)
     df_usable = df[(df["usable"] == True) & df["builds"].isna()]
 
     if args.project:
@@ -84,29 +230,63 @@ def main():
             df_usable["program_name"].str.startswith(args.project + "_")
         ]
     print(f"CSV FILE: {args.file}")
+    prefiltered = 0
+    worker = None
+    worker_dir = None
 
     for index, row in df_usable.iterrows():
         program_name = row["program_name"]
         project = program_name.split("_")[0]
         llm_test_file = row.get("llm_test_file")
-        python = sys.executable
 
         project_dir = tmp_dir / program_name
+        python = venv_pool.select_python(args.env, project, project_dir)
         original_test_file = project_dir / TEST_FILES[project]
         llm_test_path = original_test_file.with_name(str(llm_test_file))
+
+        # Without an environment for the checkout, its tests can't be collected at all
+        if python is None:
+            print(f"[{program_name}] BUILD FILTER: {llm_test_file}")
+            print("**ERROR: NO PYTHON ENVIRONMENT FOR THIS CHECKOUT ...")
+            record_result(df, index, program_name, False, "install")
+            df.to_csv(results_csv, index=False)
+            continue
+        pytest = "pytest" if args.env == "system" else str(venv_pool.pytest_executable(python))
         
+        # Skip pytest for files that are known to fail collection
+        if not args.no_prefilter:
+            build_reason = prefilter(llm_test_path, project_dir, python)
+            if build_reason is not None:
+                print(f"[{program_name}] BUILD FILTER (pre-filter): {llm_test_file}")
+                record_result(df, index, program_name, False, build_reason)
+                prefiltered += 1
+                df.to_csv(results_csv, index=False)
+                continue
+
         print(f"[{program_name}] BUILD FILTER (pytest --collect-only): {llm_test_file}")
 
+        # Start a worker for each checkout that imports pytest and the project once for all of its LLM test files
+        if args.worker and worker_dir != project_dir:
+            pytest_worker.stop_worker(worker)
+            worker = pytest_worker.start_worker(
+                python, project_dir, pytest_worker.preload_modules(original_test_file),
+                test_file=original_test_file.relative_to(project_dir)
+            )
+            worker_dir = project_dir
+
         # Run pytest --collect-only to replicate build filter (to check if extended test can compile)
-        result = subprocess.run(
-            ["pytest", "--collect-only", str(llm_test_path.relative_to(project_dir))],
-            cwd=str(project_dir),
-            stdout=subprocess.PIPE,
-            text=True,
-            stderr=subprocess.PIPE
+        result, status = pytest_worker.run_pytest(
+            worker, [pytest], ["--collect-only", str(llm_test_path.relative_to(project_dir))], project_dir, limits
         )
+        df.loc[index, "exec_status"] = status
 
-        record_result(df, program_name, result)
+        # A collection stopped by the sandbox (timeout, cpu_time, memory or crashed) records the exec status as the reason
+        builds_bool = (result.returncode == 0 and status == sandbox.OK)
+        build_reason = "" if builds_bool else (collection_reason(result) if status == sandbox.OK else status)
+        record_result(df, index, program_name, builds_bool, build_reason)
         df.to_csv(results_csv, index=False)
+
+    pytest_worker.stop_worker(worker)
+    print(f"PYTEST RUNS SKIPPED BY THE PRE-FILTER: {prefiltered}")
         
 main()
\ No newline at end of file
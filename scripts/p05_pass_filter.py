@@ -2,7 +2,14 @@ import argparse
 from pathlib import Path
 import sys
 import pandas as pd
+import tempfile
 import subprocess
+import ast
+import xml.etree.ElementTree as ET
+import venv_pool
+import pytest_worker
+import sandbox
+import coverage_store
 
 TEST_FILES = {
     "ansible": "test/units/errors/test_errors.py", 
@@ -28,6 +35,30 @@ TEST_FILES = {
     "youtubedl": "test/test_age_restriction.py"
 }
 
+CUT_FILES = {
+    "ansible": "lib/ansible/errors/__init__.py",
+    "black": "black.py", 
+    "calculator": "src/calc/__init__.py", 
+    "cookiecutter": "cookiecutter/generate.py", 
+    "expression": "src/expression/expr/arithmetic.py", 
+    "fastapi": "fastapi/encoders.py", 
+    "httpie": "httpie/cli.py", 
+    "keras": "keras/losses.py", 
+    "luigi": "luigi/interface.py", 
+    "markup": "src/markup/__init__.py", 
+    "matplotlib": "lib/matplotlib/container.py", 
+    "middle": "src/middle/__init__.py", 
+    "pandas": "pandas/core/indexes/numeric.py", 
+    "pysnooper": "pysnooper/tracer.py", 
+    "sanic": "sanic/app.py", 
+    "scrapy": "scrapy/commands/fetch.py", 
+    "spacy": "spacy/util.py", 
+    "thefuck": "thefuck/logs.py", 
+    "tornado": "tornado/escape.py", 
+    "tqdm": "tqdm/_tqdm.py",
+    "youtubedl": "youtube_dl/YoutubeDL.py"
+}
+
 # Check if project input is valid
 def validate_project(project):
     if project:
@@ -38,15 +69,269 @@ def validate_project(project):
                 "\n".join(sorted(TEST_FILES.keys()))
             ) 
           
+# Number of times each LLM test file is run to detect flakiness
+RUNS = 5
+
+# pytest exit codes that mean the tests didn't run at all (interrupted by collection errors, internal error, usage error,
+# no tests collected), which every further run would repeat
+COLLECTION_EXIT_CODES = [2, 3, 4, 5]
+
+# With --adaptive, a test is borderline if its slowest run took this many times as long as its fastest (and at least
+# BORDERLINE_SECONDS longer), or if the file imports a module that often makes tests nondeterministic
+BORDERLINE_RATIO = 3.0
+BORDERLINE_SECONDS = 0.05
+NONDETERMINISTIC_MODULES = ["random", "time", "datetime", "uuid", "threading", "multiprocessing", "asyncio", "socket", "tempfile"]
+
+# Read the outcome of every test in a JUnit XML report as {test ID: [outcome, ...]} (a test run several times in one
+# session has one outcome per run). Returns None if pytest didn't write a report (e.g. it crashed)
+def read_junit(junit_path, durations=None):
+    try:
+        root = ET.parse(junit_path).getroot()
+    except (OSError, ET.ParseError):
+        return None
+
+    outcomes = {}
+    for testcase in root.iter("testcase"):
+        test_id = f"{testcase.get('classname')}::{testcase.get('name')}"
+        outcome = "passed"
+        for result in ["failure", "error", "skipped"]:
+            if testcase.find(result) is not None:
+                outcome = {"failure": "failed", "error": "error", "skipped": "skipped"}[result]
+        outcomes.setdefault(test_id, []).append(outcome)
+
+        # Also collect the run time of every test (in seconds) if asked to
+        if durations is not None:
+            durations.setdefault(test_id, []).append(float(testcase.get("time") or 0))
+    return outcomes
+
+# Check if an LLM test file imports a module that often makes tests nondeterministic (random numbers, clocks, threads, ...)
+def uses_nondeterminism(test_file):
+    try:
+        tree = ast.parse(Path(test_file).read_text(encoding="utf-8"))
+    except (OSError, SyntaxError, UnicodeDecodeError):
+        return False
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            modules = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module:
+            modules = [node.module]
+        else:
+            continue
+        if any(module.split(".")[0] in NONDETERMINISTIC_MODULES for module in modules):
+            return True
+    return False
+
+# Check if the timing of any test varies so much between runs that more runs are needed to trust it
+def timing_is_borderline(durations):
+    for test_durations in durations.values():
+        fastest, slowest = min(test_durations), max(test_durations)
+        if slowest - fastest >= BORDERLINE_SECONDS and slowest >= BORDERLINE_RATIO * fastest:
+            return True
+    return False
+
+# Run an LLM test file RUNS times and collect the outcomes of its tests: as separate pytest runs (subprocess), repeated in
+# one pytest session (session), or in parallel pytest-xdist workers that each run the whole file (xdist).
+# With an `adaptive` policy ({"min_runs", "max_runs", "nondeterministic", "prune"}), separate runs stop as soon as the outcome
+# is decided, and only borderline files get more runs (returns the outcomes and the number of runs). When pruning, a
+# divergence doesn't stop the runs, because the other tests of the file are still judged one by one.
+# A run stopped by the sandbox's `limits` ends the repetitions, and its exec status is returned as well.
+# With `coverage` ({"cut_file", "scope"}), the first run (or the only pytest session) also collects coverage into coverage["files"]
+def run_repetitions(repeat_mode, worker, python, project_dir, test_path, runs, adaptive=None, limits=None, coverage=None):
+    command = [str(python), "-m", "pytest"]
+    outcomes = {}
+    durations = {}
+
+    with tempfile.TemporaryDirectory() as report_dir:
+        if repeat_mode == "subprocess":
+            max_runs = adaptive["max_runs"] if adaptive else runs
+
+            for i in range(max_runs):
+                print(f"RUN #{i+1} ...")
+                junit_path = Path(report_dir) / f"run_{i}.xml"
+                result, status = run_once(
+                    worker, command, [test_path, f"--junitxml={junit_path}"], project_dir, limits, coverage if i == 0 else None
+                )
+
+                # Without a report, the return code (or why the sandbox stopped the run) stands in for the outcome of the run.
+                # The durations of the coverage run are slowed down by the tracer, so they don't count for the timing check
+                timed = coverage is None or i > 0
+                run_outcomes = read_junit(junit_path, durations if timed else None) or {"<pytest>": [run_outcome(result, status)]}
+                for test_id, test_outcomes in run_outcomes.items():
+                    outcomes.setdefault(test_id, []).extend(test_outcomes)
+
+                if status != sandbox.OK:
+                    print(f"STOPPED BY THE SANDBOX ({status}) ...")
+                    return outcomes, i + 1, status
+
+                if adaptive is None:
+                    continue
+
+                # Tests that didn't run at all won't run in later runs either, and a divergence already decides the trial
+                if i == 0 and result.returncode in COLLECTION_EXIT_CODES:
+                    print(f"STOPPING EARLY: PYTEST EXIT CODE {result.returncode} ...")
+                    return outcomes, i + 1, status
+                if not adaptive["prune"] and judge(outcomes, i + 1)[1]:
+                    print("STOPPING EARLY: OUTCOMES DIVERGED ...")
+                    return outcomes, i + 1, status
+
+                # Stable files are decided after the minimum number of runs, borderline files after the maximum
+                borderline = adaptive["nondeterministic"] or timing_is_borderline(durations)
+                if i + 1 >= (max_runs if borderline else adaptive["min_runs"]):
+                    if borderline:
+                        print(f"BORDERLINE TIMING OR IMPORTS: RAN {i + 1} TIMES ...")
+                    return outcomes, i + 1, status
+            return outcomes, max_runs, sandbox.OK
+
+        junit_path = Path(report_dir) / "runs.xml"
+        if repeat_mode == "session":
+            print(f"RUNS #1-{runs} IN ONE SESSION ...")
+            pytest_args = ["--keep-duplicates"] + [test_path] * runs
+        else:
+            print(f"RUNS #1-{runs} IN {runs} XDIST WORKERS ...")
+            pytest_args = [test_path, "-n", str(runs), "--dist", "each"]
+
+        result, status = run_once(worker, command, pytest_args + [f"--junitxml={junit_path}"], project_dir, limits, coverage)
+        if status != sandbox.OK:
+            print(f"STOPPED BY THE SANDBOX ({status}) ...")
+        return read_junit(junit_path) or {"<pytest>": [run_outcome(result, status)] * runs}, runs, status
+
+# Run pytest once in the worker (or as a subprocess), or under coverage if `coverage` is given, storing the line sets in
+# coverage["files"]. A coverage run always starts a new process, because modules the worker imported already wouldn't be measured
+def run_once(worker, command, pytest_args, project_dir, limits, coverage=None):
+    if coverage is None:
+        return pytest_worker.run_pytest(worker, command, pytest_args, project_dir, limits)
+
+    print("COLLECTING COVERAGE ...")
+    result, coverage["files"], status, _ = coverage_store.pytest_coverage(
+        command[0], project_dir, [], stderr=subprocess.PIPE, limits=limits, cut_file=coverage["cut_file"],
+        scope=coverage["scope"], pytest_args=pytest_args
+    )
+    return result, status
+
+# Outcome of a pytest run that didn't write a report
+def run_outcome(result, status):
+    return f"exit code {result.returncode}" if status == sandbox.OK else status
+
+# Owner (class, or module for a function) and name of a test ID without its parameters. A test ID is
+# <module>.<class>::<name> for a method and <module>::<name> for a function, e.g. ("TestA", "test_b") for
+# tests.test_a.TestA::test_b[1-2]
+def test_function(test_id):
+    classname, _, name = test_id.partition("::")
+    return classname.split(".")[-1], name.split("[")[0]
+
+# Owner and full name (with parameters) of a test ID, with the owner renamed by `rename` (e.g. the module of a pruned copy
+# to the module of its original)
+def test_name(test_id, rename=None):
+    classname, _, name = test_id.partition("::")
+    owner = classname.split(".")[-1]
+    return (rename or {}).get(owner, owner), name
+
+# Remove the test functions and methods of the given test IDs from an LLM test file named `module_name` (parametrized
+# tests are removed as a whole). A class left without statements gets a `pass`. Returns None if the file can't be parsed
+def prune_tests(source, test_ids, module_name):
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        return None
+
+    removed = {test_function(test_id) for test_id in test_ids}
+
+    lines = source.splitlines(keepends=True)
+    drop = set()
+    empty_classes = []
+
+    def remove(node, owner):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)) and (owner, node.name) in removed:
+            start = min([node.lineno] + [decorator.lineno for decorator in node.decorator_list])
+            drop.update(range(start, node.end_lineno + 1))
+            return True
+        return False
+
+    for node in tree.body:
+        if isinstance(node, ast.ClassDef):
+            kept = [child for child in node.body if not remove(child, node.name)]
+            if not kept:
+                empty_classes.append(node)
+        else:
+            remove(node, module_name)
+
+    pruned = []
+    for number, line in enumerate(lines, start=1):
+        if number not in drop:
+            pruned.append(line)
+        for node in empty_classes:
+            if number == node.body[-1].end_lineno:
+                pruned.append(" " * node.body[0].col_offset + "pass\n")
+    return "".join(pruned)
+
+# Judge flakiness per test ID: a test is flaky if its outcome differs between runs (or it is missing from some runs),
+# and failing if it failed the same way in every run (returns (test IDs, flaky test IDs, failing test IDs)).
+# A file that can't be collected (an ID without a class, ::<module>) is reported once per session, so only its outcome counts
+def judge(outcomes, runs):
+    flaky = []
+    failing = []
+    for test_id, test_outcomes in outcomes.items():
+        missing = len(test_outcomes) != runs and not test_id.startswith("::")
+        if len(set(test_outcomes)) > 1 or missing:
+            flaky.append(test_id)
+        elif test_outcomes[0] != "passed":
+            failing.append(test_id)
+    return list(outcomes), flaky, failing
+
+# Write a copy of an LLM test file without its flaky and failing tests (<name>_pruned.py) and check that it passes in one
+# more run. Returns the pruned file's path, or None if nothing stable is left or the file can't be pruned
+def write_pruned(worker, python, project_dir, llm_test_path, test_ids, unstable, limits=None):
+    # A file that can't be collected (or a run without a report) has no tests that could be kept
+    stable = [test_id for test_id in test_ids if test_id not in unstable]
+    if not stable or any(test_id.startswith(("::", "<")) for test_id in unstable):
+        return None
+
+    source = prune_tests(llm_test_path.read_text(encoding="utf-8"), unstable, llm_test_path.stem)
+    if source is None:
+        return None
+    pruned_path = llm_test_path.with_name(f"{llm_test_path.stem}_pruned.py")
+    pruned_path.write_text(source, encoding="utf-8")
+
+    print(f"PRUNED RUN: {pruned_path.name} ...")
+    with tempfile.TemporaryDirectory() as report_dir:
+        junit_path = Path(report_dir) / "pruned.xml"
+        _, status = pytest_worker.run_pytest(
+            worker,
+            [str(python), "-m", "pytest"],
+            [str(pruned_path.relative_to(project_dir)), f"--junitxml={junit_path}"],
+            project_dir,
+            limits
+        )
+        outcomes = read_junit(junit_path)
+
+    # Parametrized tests are removed as a whole, so the stable cases of a partly failing one aren't expected either
+    removed = {test_function(test_id) for test_id in unstable}
+    expected = {test_name(test_id) for test_id in stable if test_function(test_id) not in removed}
+    ran = {test_name(test_id, {pruned_path.stem: llm_test_path.stem}) for test_id in outcomes or {}}
+    if status != sandbox.OK or not outcomes or ran != expected or any(test_outcomes != ["passed"] for test_outcomes in outcomes.values()):
+        print("**ERROR: PRUNED FILE DOESN'T PASS, DISCARDING ...")
+        pruned_path.unlink()
+        return None
+    return pruned_path
+
 # Update pass column with either true or false, and update discard_reason column with 2 if pass failed
-def record_result(df, program_name, passes_bool):
-    df.loc[df["program_name"] == program_name, "passes"] = passes_bool
+# (also if a run was stopped by the sandbox, whose exec status is recorded in the exec_status column, or if the checkout has
+# no environment, recorded as install)
+def record_result(df, index, program_name, passes_bool, status=sandbox.OK):
+    df.loc[index, "passes"] = passes_bool
         
-    if not passes_bool:
-        df.loc[df["program_name"] == program_name, "discard_reason"] = 2
+    if not passes_bool and status == "install":
+        df.loc[index, "discard_reason"] = 2
+        print("FAILED: NO PYTHON ENVIRONMENT FOR THIS CHECKOUT ...")
+    elif not passes_bool and status != sandbox.OK:
+        df.loc[index, "discard_reason"] = 2
+        print(f"FAILED: STOPPED BY THE SANDBOX ({status}) ...")
+    elif not passes_bool:
+        df.loc[index, "discard_reason"] = 2
         print("FAILED: FLAKY DETECTED ...")
     else:
-        df.loc[df["program_name"] == program_name, "discard_reason"] = pd.NA
+        df.loc[index, "discard_reason"] = pd.NA
         print("SUCCESS: NO FLAKY DETECTED ...")
             
 # Apply Meta's TestGen-LLM's second filter, which is to check for flakiness from five runs
@@ -63,24 +348,92 @@ def main():
         default="results.csv",
         help="CSV filename in results directory that records the data."
     )
+
+    parser.add_argument(
+        "-e", "--env",
+        choices=["venv", "system"],
+        default="venv",
+        help="venv = run tests in the project's pooled virtual environment, system = use this interpreter."
+    )
     
+    parser.add_argument(
+        "-r", "--repeat-mode",
+        choices=["subprocess", "session", "xdist"],
+        default="subprocess",
+        help="subprocess = one pytest run per repetition, session = all repetitions in one pytest session, "
+             "xdist = repetitions in parallel pytest-xdist workers."
+    )
+
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="with -r subprocess, stop once the outcome is decided (after --min-runs, a divergence or a collection error) "
+             "and run borderline files up to --max-runs times."
+    )
+
+    parser.add_argument(
+        "--min-runs",
+        type=int,
+        default=2,
+        help="with --adaptive, runs of a file whose tests agree and whose timing isn't borderline."
+    )
+
+    parser.add_argument(
+        "--max-runs",
+        type=int,
+        default=10,
+        help="with --adaptive, maximum runs of a borderline file."
+    )
+
+    parser.add_argument(
+        "--with-coverage",
+        action="store_true",
+        help="collect coverage (in --cov-scope) in the first run and store it for p06, which then doesn't run pytest."
+    )
+
+    coverage_store.add_scope_argument(parser)
+
+    parser.add_argument(
+        "--prune",
+        action="store_true",
+        help="keep the stable tests of a trial with flaky or failing tests in a pruned copy of its LLM test file (used by p06)."
+    )
+
+    sandbox.add_arguments(parser, 300)
+
+    parser.add_argument(
+        "--worker",
+        action="store_true",
+        help="run pytest in forked children of a worker that has pytest and the project imported already (not on Windows)."
+    )
+
     args = parser.parse_args()
     validate_project(args.project)
+    if args.adaptive and args.repeat_mode != "subprocess":
+        sys.exit("Invalid --adaptive. It needs -r subprocess.")
+    if not 1 <= args.min_runs <= args.max_runs:
+        sys.exit("Invalid --min-runs/--max-runs. Use 1 <= --min-runs <= --max-runs.")
     
     scripts_dir = Path(__file__).absolute().parent
     tmp_dir = scripts_dir / "tmp"
     results_dir = scripts_dir.parent / "results"
     results_csv = results_dir / args.file
-    python = sys.executable
     
     # Read results.csv and iterate through any projects that have passed the build filter
     df = pd.read_csv(results_csv)
+    df["exec_status"] = df.get("exec_status", pd.Series(pd.NA, index=df.index)).astype("string")
+    limits = sandbox.limits_from_args(args)
     df_pass = df[(df["usable"] == True) & (df["builds"] == True) & df["passes"].isna()]
     
     if args.project:
         df_pass = df_pass[df_pass["program_name"].str.startswith(args.project + "_")]
     
     print(f"CSV FILE: {args.file}")
+    worker = None
+    worker_dir = None
+    total_runs = 0
+    num_trials = 0
+    conn = coverage_store.connect() if args.with_coverage else None
     
     for index, row in df_pass.iterrows():
         program_name = row["program_name"]
@@ -88,31 +441,77 @@ def main():
         llm_test_file = row.get("llm_test_file")
         
         project_dir = tmp_dir / program_name
+        python = venv_pool.select_python(args.env, project, project_dir)
         original_test_file = project_dir / TEST_FILES[project]
         llm_test_path = original_test_file.with_name(str(llm_test_file))
         
         print(f"[{program_name}] PASS FILTER: {llm_test_file}")
+
+        # Without an environment for the checkout, its tests can't run at all
+        if python is None:
+            df.loc[index, "exec_status"] = "install"
+            record_result(df, index, program_name, False, "install")
+            df.to_csv(results_csv, index=False)
+            continue
         
-        # Run the pass filter 5 times to catch flakiness by using pytest
-        outputs = []
-        passes_bool = True
-
-        for i in range(5):
-            print(f"RUN #{i+1} ...")
-
-            result = subprocess.run(
-                [python, "-m", "pytest", str(llm_test_path.relative_to(project_dir))],
-                cwd=str(project_dir),
-                stdout=subprocess.PIPE,
-                text=True,
-                stderr=subprocess.PIPE
+        # Start a worker for each checkout that imports pytest and the project once for all runs of its LLM test files
+        if args.worker and worker_dir != project_dir:
+            pytest_worker.stop_worker(worker)
+            worker = pytest_worker.start_worker(
+                python, project_dir, pytest_worker.preload_modules(original_test_file), module_mode=True,
+                test_file=original_test_file.relative_to(project_dir)
             )
-            outputs.append(result.returncode)
+            worker_dir = project_dir
+
+        # Run the pass filter 5 times to catch flakiness by using pytest, comparing the outcome of every test between runs
+        adaptive = None
+        if args.adaptive:
+            adaptive = {"min_runs": args.min_runs, "max_runs": args.max_runs, "nondeterministic": uses_nondeterminism(llm_test_path),
+                        "prune": args.prune}
+
+        # With --with-coverage, one of the runs also measures coverage (by default of the package that contains the CUT)
+        coverage = None
+        if args.with_coverage:
+            coverage = {"cut_file": CUT_FILES[project], "scope": args.cov_scope, "files": None}
+
+        outcomes, runs, status = run_repetitions(
+            args.repeat_mode, worker, python, project_dir, str(llm_test_path.relative_to(project_dir)), RUNS, adaptive, limits,
+            coverage
+        )
+        test_ids, flaky, failing = judge(outcomes, runs)
+        passes_bool = not flaky and status == sandbox.OK
+        total_runs += runs
+        num_trials += 1
 
-        if passes_bool:
-            passes_bool = (len(set(outputs)) == 1)
+        df.loc[index, "pass_runs"] = runs
+        df.loc[index, "exec_status"] = status
+        df.loc[index, "num_tests"] = len(test_ids)
+        df.loc[index, "flaky_tests"] = len(flaky)
+        df.loc[index, "failing_tests"] = len(failing)
+        for test_id in flaky:
+            print(f"FLAKY: {test_id} {outcomes[test_id]}")
 
-        record_result(df, program_name, passes_bool)
+        # Instead of discarding the whole class, keep the tests that passed in every run
+        if args.prune and (flaky or failing) and status == sandbox.OK:
+            pruned_path = write_pruned(worker, python, project_dir, llm_test_path, test_ids, flaky + failing, limits)
+            if pruned_path is not None:
+                passes_bool = True
+                df.loc[index, "pruned_test_file"] = pruned_path.name
+                print(f"PRUNED: REMOVED {len(flaky) + len(failing)} OF {len(test_ids)} TESTS ...")
+
+        record_result(df, index, program_name, passes_bool, status)
+
+        # Keep the coverage of the LLM test file for p06 (a pruned file has fewer tests than the run that measured it)
+        if coverage is not None and coverage["files"] is not None and passes_bool and pd.isna(df.loc[index].get("pruned_test_file")):
+            key = coverage_store.trial_key(Path(args.file).stem + "_pass", program_name, llm_test_file)
+            coverage_store.save_trial(conn, key, program_name, [str(llm_test_path.relative_to(project_dir))], coverage["files"],
+                                       args.cov_scope)
+            print("COVERAGE STORED FOR p06 ...")
+
+    pytest_worker.stop_worker(worker)
     df.to_csv(results_csv, index=False)
 
+    if num_trials:
+        print(f"AVERAGE RUNS PER TRIAL: {total_runs / num_trials:.2f} ({total_runs} RUNS FOR {num_trials} TRIALS)")
+
 main()
\ No newline at end of file
@@ -3,6 +3,9 @@ from pathlib import Path
 import sys
 import subprocess
 import pandas as pd
+import venv_pool
+import coverage_store
+import sandbox
 
 TEST_FILES = {
     "ansible": "test/units/errors/test_errors.py", 
@@ -28,6 +31,30 @@ TEST_FILES = {
     "youtubedl": "test/test_age_restriction.py"
 }
 
+CUT_FILES = {
+    "ansible": "lib/ansible/errors/__init__.py",
+    "black": "black.py", 
+    "calculator": "src/calc/__init__.py", 
+    "cookiecutter": "cookiecutter/generate.py", 
+    "expression": "src/expression/expr/arithmetic.py", 
+    "fastapi": "fastapi/encoders.py", 
+    "httpie": "httpie/cli.py", 
+    "keras": "keras/losses.py", 
+    "luigi": "luigi/interface.py", 
+    "markup": "src/markup/__init__.py", 
+    "matplotlib": "lib/matplotlib/container.py", 
+    "middle": "src/middle/__init__.py", 
+    "pandas": "pandas/core/indexes/numeric.py", 
+    "pysnooper": "pysnooper/tracer.py", 
+    "sanic": "sanic/app.py", 
+    "scrapy": "scrapy/commands/fetch.py", 
+    "spacy": "spacy/util.py", 
+    "thefuck": "thefuck/logs.py", 
+    "tornado": "tornado/escape.py", 
+    "tqdm": "tqdm/_tqdm.py",
+    "youtubedl": "youtube_dl/YoutubeDL.py"
+}
+
 # Check if project input is valid
 def validate_project(project):
     if project:
@@ -37,14 +64,6 @@ def validate_project(project):
                 "Available Tests4Py projects:\n" +
                 "\n".join(sorted(TEST_FILES.keys()))
             ) 
-            
-# Parse the coverage report output to get the coverage number only
-def get_coverage_number(result2):
-    for line in result2.stdout.splitlines():
-        line = line.strip()
-
-        if line.startswith("TOTAL"):
-            return line.split()[-1].replace("%", "")
 
 # Run a LLM-generated test file with pytest to record its statement coverage
 def main():
@@ -62,48 +81,133 @@ def main():
         help="CSV filename in results directory that records the data."
     )
 
+    parser.add_argument(
+        "-e", "--env",
+        choices=["venv", "system"],
+        default="venv",
+        help="venv = run tests in the project's pooled virtual environment, system = use this interpreter."
+    )
+
+    sandbox.add_arguments(parser, 900)
+
+    coverage_store.add_scope_argument(parser)
+
     args = parser.parse_args()
     validate_project(args.project)
     
     scripts_dir = Path(__file__).absolute().parent
     tmp_dir = scripts_dir / "tmp"
-    python = sys.executable
 
     results_dir = scripts_dir.parent / "results"
     results_csv = results_dir / args.file
 
     # Read results.csv and iterate through any projects that have passed the previous two filters
     df = pd.read_csv(results_csv)
+    df["exec_status"] = df.get("exec_status", pd.Series(pd.NA, index=df.index)).astype("string")
+    df["kept"] = df["kept"].astype("object")
+    limits = sandbox.limits_from_args(args)
     df_cov = df[(df["usable"] == True) & (df["builds"] == True) & (df["passes"] == True) & df["kept"].isna()]
+    conn = coverage_store.connect()
     
     if args.project:
         df_cov = df_cov[df_cov["program_name"].str.startswith(args.project + "_")]
     print(f"CSV FILE: {args.file}")
+
+    # coverage_before was measured by p02, so the stored baselines must have the same scope as this run (otherwise the
+    # coverage delta of p07 compares two different scopes)
+    for program_name in df_cov["program_name"].unique():
+        baseline_key = coverage_store.trial_key("baseline", program_name)
+        baseline_scope = coverage_store.trial_scope(conn, baseline_key)
+        if coverage_store.load_trial(conn, baseline_key) is not None and baseline_scope != args.cov_scope:
+            sys.exit(
+                f"**ERROR: THE BASELINE OF {program_name} WAS MEASURED WITH --cov-scope {baseline_scope}, NOT {args.cov_scope}.\n"
+                f"Run p02 with --cov-scope {args.cov_scope} first, or run p06 with the scope of the baselines."
+            )
     
     for index, row in df_cov.iterrows():
         program_name = row["program_name"]
         project = program_name.split("_")[0]
         llm_test_file = row.get("llm_test_file")
+
+        # A trial pruned by p05 --prune is measured with the copy that only has its stable tests
+        if pd.notna(row.get("pruned_test_file")):
+            llm_test_file = row["pruned_test_file"]
         
         project_dir = tmp_dir / program_name
+        python = venv_pool.select_python(args.env, project, project_dir)
         original_test_file = project_dir / TEST_FILES[project]
         llm_test_path = original_test_file.with_name(str(llm_test_file))
         
         print(f"[{program_name}] LLM COVERAGE: {llm_test_file}")
+
+        # Without an environment for the checkout, its coverage can't be measured (discarded like a stopped run)
+        if python is None:
+            print("**ERROR: NO PYTHON ENVIRONMENT FOR THIS CHECKOUT, DISCARDING ...")
+            df.loc[index, "exec_status"] = "install"
+            df.loc[index, "kept"] = False
+            df.loc[index, "discard_reason"] = 3
+            df.to_csv(results_csv, index=False)
+            continue
         
-        # Run pytest --cov --cov-report=term on the LLM-generated test file only
-        result2 = subprocess.run(
-            [python, "-m", "pytest", str(original_test_file.relative_to(project_dir)), str(llm_test_path.relative_to(project_dir)), "--cov", "--cov-report=term"],
-            cwd=str(project_dir),
-            stdout=subprocess.PIPE,
-            text=True,
-            stderr=subprocess.PIPE,
-        )
-        
-        coverage_after = get_coverage_number(result2)
+        test_files = [original_test_file.relative_to(project_dir), llm_test_path.relative_to(project_dir)]
+
+        # The baseline stored by p02 is combined with the coverage of the LLM test file alone (like `coverage combine`),
+        # which p05 --with-coverage may have measured already (only if it was measured in the same --cov-scope)
+        baseline = coverage_store.load_trial(conn, coverage_store.trial_key("baseline", program_name))
+        stored = None
+        stored_key = coverage_store.trial_key(Path(args.file).stem + "_pass", program_name, llm_test_file)
+        if baseline is not None and pd.isna(row.get("pruned_test_file")) \
+                and coverage_store.trial_scope(conn, stored_key) == args.cov_scope:
+            stored = coverage_store.load_trial(conn, stored_key)
+
+        if stored is not None:
+            print("LOADING COVERAGE STORED BY p05 ...")
+            llm_files = stored
+            status = sandbox.OK
+
+        elif baseline is not None:
+            print("RUNNING THE LLM TEST FILE ONLY ...")
+            result2, llm_files, status, _ = coverage_store.pytest_coverage(
+                python, project_dir, [llm_test_path.relative_to(project_dir)], stderr=subprocess.PIPE, limits=limits,
+                cut_file=CUT_FILES[project], scope=args.cov_scope
+            )
+
+        else:
+            # Without a stored baseline, run pytest --cov on the original test file together with the LLM-generated test file
+            print("**ERROR: NO BASELINE STORED BY p02, RUNNING THE ORIGINAL TEST FILE AS WELL ...")
+            result2, files, status, _ = coverage_store.pytest_coverage(
+                python, project_dir, test_files, stderr=subprocess.PIPE, limits=limits, cut_file=CUT_FILES[project],
+                scope=args.cov_scope
+            )
+        df.loc[index, "exec_status"] = status
+
         print("GETTING STATEMENT COVERAGE ...")
+        if status != sandbox.OK:
+            # The trial is decided here (p07 only decides trials with coverage): discarded by the coverage improvement
+            # filter, with the reason it was stopped in exec_status
+            print(f"**ERROR: STOPPED BY THE SANDBOX ({status}), DISCARDING ...")
+            df.loc[index, "kept"] = False
+            df.loc[index, "discard_reason"] = 3
+            df.to_csv(results_csv, index=False)
+            continue
+        if baseline is not None:
+            files = None if llm_files is None else coverage_store.union(baseline, llm_files)
+        if files is None:
+            print("**ERROR: CANNOT COLLECT COVERAGE, SKIPPING ...")
+            continue
+
+        # Lines the LLM test file covers in addition to the baseline (the exact improvement behind the percentages)
+        if baseline is not None:
+            new_lines = coverage_store.new_lines(baseline, files)
+            df.loc[index, "new_lines"] = sum(len(lines) for lines in new_lines.values())
+
+        # Keep the covered lines so that deltas and per-file breakdowns don't require running pytest again
+        key = coverage_store.trial_key(Path(args.file).stem, program_name, llm_test_file)
+        coverage_after = coverage_store.save_trial(
+            conn, key, program_name, [str(test_file) for test_file in test_files], files, args.cov_scope
+        )
         
-        df.loc[df["program_name"] == program_name, "coverage_after"] = int(coverage_after)
+        df.loc[index, "coverage_after"] = int(coverage_after)
         print("SUCCESS: COVERAGE COLLECTED ...")
             
         df.to_csv(results_csv, index=False)
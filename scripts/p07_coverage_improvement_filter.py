@@ -1,6 +1,7 @@
 import argparse
 from pathlib import Path
 import sys
+import os
 import pandas as pd
 
 TEST_FILES = {
@@ -37,16 +38,27 @@ def validate_project(project):
                 "\n".join(sorted(TEST_FILES.keys()))
             ) 
 
-# Update kept column with either true or false, and update discard_reason column with 3 if kept failed
-def record_result(df, program_name, kept_bool, coverage_delta):
-    if not kept_bool:
-        df.loc[df["program_name"] == program_name, "discard_reason"] = 3
-        print(f"DISCARDED (coverage_delta={coverage_delta}): {program_name} ...")
-        
-    else:
-        df.loc[df["program_name"] == program_name, "discard_reason"] = pd.NA
-        print(f"IMPROVEMENT SUCCESS: {program_name} ...")
-    
+# Columns that identify a trial: its candidates (the sample column from p03 --samples) share them
+TRIAL_COLUMNS = ["program_name", "prompt_mode", "llm_model"]
+
+# Mark the best candidate of every trial among the improving rows: the largest coverage delta, then the most new lines
+# (from p06), then the first sample
+def best_candidates(df_cov, improves):
+    candidates = df_cov[improves].copy()
+    candidates["order"] = range(len(candidates))
+    sort_columns = ["coverage_delta"] + (["new_lines"] if "new_lines" in candidates.columns else []) + ["order"]
+    ascending = [False] * (len(sort_columns) - 1) + [True]
+
+    trial_columns = [column for column in TRIAL_COLUMNS if column in candidates.columns]
+    best = candidates.sort_values(sort_columns, ascending=ascending, na_position="last").drop_duplicates(trial_columns)
+    return df_cov.index.isin(best.index)
+
+# Write the CSV to a temporary file first and then replace the old one, so that an interrupted run can't truncate it
+def write_csv_atomic(df, results_csv):
+    tmp_csv = results_csv.with_name(results_csv.name + ".tmp")
+    df.to_csv(tmp_csv, index=False)
+    os.replace(tmp_csv, results_csv)
+
 # Apply Meta's TestGen-LLM's third filter, which is to check for coverage improvement
 def main():
     parser = argparse.ArgumentParser(description = "check for if coverage improvement has occurred on LLM-generated tests.")
@@ -62,6 +74,19 @@ def main():
         help="CSV filename in results directory that records the data."
     )
     
+    parser.add_argument(
+        "--min-delta",
+        type=int,
+        default=1,
+        help="minimum coverage delta (in percentage points) for an LLM test class to be kept (default: 1)."
+    )
+
+    parser.add_argument(
+        "--best-only",
+        action="store_true",
+        help="keep only the best improving candidate of every trial (see p03 --samples)."
+    )
+
     args = parser.parse_args()
     validate_project(args.project)
     
@@ -77,18 +102,31 @@ def main():
         df_cov = df_cov[df_cov["program_name"].str.startswith(args.project + "_")]
     
     print(f"CSV FILE: {args.file}")
-    
-    # Coverage improvement exists if difference is greater than 0
-    for index, row in df_cov.iterrows():
-        program_name = row["program_name"]
 
-        coverage_delta = int(row["coverage_after"]) - int(row["coverage_before"])
-        kept_bool = coverage_delta > 0
+    # Trials without coverage (e.g. skipped by p06) stay undecided
+    missing = df_cov["coverage_after"].isna() | df_cov["coverage_before"].isna()
+    df_cov = df_cov[~missing]
+
+    # Coverage improvement exists if the difference is at least --min-delta (greater than 0 by default), computed for all
+    # trials at once
+    coverage_delta = df_cov["coverage_after"].astype(int) - df_cov["coverage_before"].astype(int)
+    df_cov = df_cov.assign(coverage_delta=coverage_delta)
+    kept = coverage_delta >= args.min_delta
+    if args.best_only:
+        kept &= best_candidates(df_cov, kept)
+
+    df["kept"] = df["kept"].astype("object")
+    df.loc[df_cov.index, "coverage_delta"] = coverage_delta
+    df.loc[df_cov.index, "kept"] = kept
+    df.loc[df_cov.index, "discard_reason"] = kept.map({True: float("nan"), False: 3.0})
+
+    write_csv_atomic(df, results_csv)
 
-        df.loc[df["program_name"] == program_name, "coverage_delta"] = coverage_delta
-        df.loc[df["program_name"] == program_name, "kept"] = kept_bool
+    print(f"IMPROVEMENT SUCCESS: {int(kept.sum())} OF {len(df_cov)} TRIALS ...")
+    print(f"DISCARDED (coverage_delta < {args.min_delta}): {int((coverage_delta < args.min_delta).sum())} ...")
+    if args.best_only:
+        print(f"DISCARDED (not the best candidate of the trial): {int(((coverage_delta >= args.min_delta) & ~kept).sum())} ...")
+    if missing.any():
+        print(f"**ERROR: NO COVERAGE FOR {int(missing.sum())} TRIALS, SKIPPING ...")
 
-        record_result(df, program_name, kept_bool, coverage_delta)
-        df.to_csv(results_csv, index=False)
-        
 main()
\ No newline at end of file
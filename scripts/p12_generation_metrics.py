@@ -0,0 +1,90 @@
+import argparse
+from pathlib import Path
+import sys
+import pandas as pd
+
+# Ollama's durations are in nanoseconds
+NANOSECONDS = 1e9
+
+# A call that spent at least this many seconds loading the model is counted as a cold load
+COLD_LOAD_SECONDS = 1.0
+
+# Where the time of a model call goes: loading the model, evaluating the prompt, or generating the response
+SHARES = {
+    "load_duration": "model-load-bound",
+    "prompt_eval_duration": "prompt-bound",
+    "eval_duration": "generation-bound",
+}
+
+# Summarize the timing and token metrics of the model calls of one model and prompt
+def summarize(calls):
+    total = calls["total_duration"].sum()
+    eval_seconds = calls["eval_duration"].sum() / NANOSECONDS
+    prompt_seconds = calls["prompt_eval_duration"].sum() / NANOSECONDS
+
+    shares = {name: calls[name].sum() / total if total else 0.0 for name in SHARES}
+    # Calls whose stream was stopped early have estimated metrics (their model load counts as prompt evaluation)
+    estimated = int((calls["metrics_estimated"] == True).sum()) if "metrics_estimated" in calls.columns else 0
+    return {
+        "Calls": len(calls),
+        "Estimated": estimated,
+        "Cold loads": int((calls["load_duration"] >= COLD_LOAD_SECONDS * NANOSECONDS).sum()),
+        "Prompt tokens": round(calls["prompt_eval_count"].mean(), 1),
+        "Response tokens": round(calls["eval_count"].mean(), 1),
+        "Prompt tokens/s": round(calls["prompt_eval_count"].sum() / prompt_seconds, 1) if prompt_seconds else None,
+        "Generation tokens/s": round(calls["eval_count"].sum() / eval_seconds, 1) if eval_seconds else None,
+        "Load share": round(shares["load_duration"], 2),
+        "Prompt-eval share": round(shares["prompt_eval_duration"], 2),
+        "Generation share": round(shares["eval_duration"], 2),
+        "Mean latency (s)": round(calls["latency"].mean(), 2),
+        "Bound": SHARES[max(shares, key=shares.get)] if total else None,
+    }
+
+# Report tokens/s and where the generation time goes (model load, prompt evaluation, generation) per model and prompt
+def main():
+    parser = argparse.ArgumentParser(
+        description="summarize the model timing and token metrics recorded by p03 per model and prompt."
+    )
+
+    parser.add_argument(
+        "-f", "--file",
+        nargs="+",
+        default=["results.csv"],
+        help="CSV filename(s) in results directory that record the data."
+    )
+
+    parser.add_argument(
+        "-o", "--output",
+        help="also save the summary as a CSV file with this name in the results directory."
+    )
+
+    args = parser.parse_args()
+    scripts_dir = Path(__file__).absolute().parent
+    results_dir = scripts_dir.parent / "results"
+
+    df = pd.concat([pd.read_csv(results_dir / name) for name in args.file], ignore_index=True)
+    if "response_source" not in df.columns:
+        sys.exit("No generation metrics recorded. Run p03_generate_llm_tests.py to record them.")
+
+    # Cached and shared responses didn't call the model, so only the trials that did are counted
+    calls = df[df["response_source"] == "model"].copy()
+    calls["prompt_mode"] = calls["prompt_mode"].replace({
+        "TESTONLY": "EXTENDTEST",
+        "TESTCUT": "EXTENDCOV"
+    })
+
+    rows = []
+    for (model, prompt_mode), group in calls.groupby(["llm_model", "prompt_mode"]):
+        rows.append({"Model": model, "Prompt": prompt_mode, **summarize(group)})
+    summary = pd.DataFrame(rows)
+
+    print("GENERATION METRICS PER MODEL AND PROMPT:")
+    print(summary.to_string(index=False) if rows else "NO MODEL CALLS RECORDED")
+    print(f"\nTRIALS: {len(df)}, MODEL CALLS: {len(calls)}, CACHED: {(df['response_source'] == 'cache').sum()}, "
+          f"SHARED: {(df['response_source'] == 'shared').sum()}")
+
+    if args.output:
+        summary.to_csv(results_dir / args.output, index=False)
+        print(f"SUMMARY SAVED TO: {results_dir / args.output}")
+
+main()
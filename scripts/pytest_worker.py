@@ -0,0 +1,198 @@
+from pathlib import Path
+import sys
+import os
+import json
+import ast
+import time
+import signal
+import subprocess
+import tempfile
+import importlib
+import sandbox
+import venv_pool
+
+# Started inside a checkout's environment, the worker imports pytest and the project's modules once and then runs every
+# pytest invocation it is sent in a forked child, so each run starts with everything already imported
+
+# Top-level modules imported by a test file (the worker imports them before the first run)
+def preload_modules(test_file):
+    try:
+        tree = ast.parse(Path(test_file).read_text(encoding="utf-8"))
+    except (OSError, SyntaxError, UnicodeDecodeError):
+        return []
+
+    modules = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            modules += [alias.name.split(".")[0] for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            modules.append(node.module.split(".")[0])
+    return sorted(set(modules))
+
+# Directories that pytest's default (prepend) import mode puts first on sys.path before it imports a test file: for every
+# conftest.py from the checkout down to the test file's directory, and then for the test file, the first directory above
+# it that isn't a package (in the order pytest inserts them)
+def pytest_import_dirs(project_dir, test_file):
+    project_dir = Path(project_dir).absolute()
+    test_file = project_dir / test_file
+    parents = [parent for parent in reversed(test_file.parents) if parent == project_dir or project_dir in parent.parents]
+    modules = [parent / "conftest.py" for parent in parents if (parent / "conftest.py").exists()] + [test_file]
+
+    dirs = []
+    for module in modules:
+        base = module.parent
+        while (base / "__init__.py").exists() and base != base.parent:
+            base = base.parent
+        dirs.append(str(base))
+    return dirs
+
+# Start a worker for a checkout. `module_mode` puts the checkout on sys.path like `python -m pytest` does, and the
+# directories pytest inserts for `test_file` (relative to the checkout) are put on it before preloading, so that the
+# preloaded modules resolve as they would in the runs (returns None where fork isn't available, so that callers run
+# pytest as a subprocess instead)
+def start_worker(python, project_dir, preload=(), module_mode=False, test_file=None):
+    if not hasattr(os, "fork"):
+        return None
+
+    command = [str(python), str(Path(__file__).absolute()), "--serve"] + (["--module-mode"] if module_mode else [])
+    if test_file is not None:
+        command.append(f"--test-file={test_file}")
+    process = subprocess.Popen(
+        command + list(preload),
+        cwd=str(project_dir),
+        env=dict(os.environ, **venv_pool.checkout_env(project_dir, python)),
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True
+    )
+
+    # The worker reports once everything is imported
+    if process.stdout.readline().strip() != "ready":
+        stop_worker(process)
+        return None
+    return process
+
+# Stop a worker (and with it, the checkout's preloaded modules)
+def stop_worker(worker):
+    if worker is None:
+        return
+    try:
+        worker.stdin.close()
+        worker.wait(timeout=10)
+    except (OSError, subprocess.TimeoutExpired):
+        worker.kill()
+
+# Run pytest with `pytest_args` in a worker, or as `command` + `pytest_args` in the sandbox without one, with the sandbox's
+# `limits` either way (returns the completed process and its exec status)
+def run_pytest(worker, command, pytest_args, project_dir, limits=None):
+    if worker is not None and worker.poll() is None:
+        try:
+            worker.stdin.write(json.dumps({"args": pytest_args, "limits": limits}) + "\n")
+            worker.stdin.flush()
+            reply = json.loads(worker.stdout.readline())
+            result = subprocess.CompletedProcess(command + pytest_args, reply["returncode"], reply["stdout"], reply["stderr"])
+            return result, reply["status"]
+        except (OSError, ValueError):
+            print("**ERROR: PYTEST WORKER STOPPED, RUNNING PYTEST AS A SUBPROCESS ...")
+            worker.kill()
+
+    return sandbox.run(command + pytest_args, project_dir, limits, stderr=subprocess.PIPE)
+
+# Run one pytest invocation in a forked child with the sandbox's limits and a private temp directory (in its own process
+# group, so a timeout also kills what it started)
+def fork_run(args, limits):
+    limits = limits or {}
+    timeout = limits.get("timeout")
+    with tempfile.TemporaryFile() as stdout_file, tempfile.TemporaryFile() as stderr_file, \
+            tempfile.TemporaryDirectory(prefix="sandbox_") as temp_dir:
+        pid = os.fork()
+        if pid == 0:
+            returncode = 1
+            try:
+                os.setsid()
+                sandbox.apply_limits(limits)
+                os.environ.update(sandbox.private_env(temp_dir))
+                tempfile.tempdir = temp_dir
+                os.dup2(stdout_file.fileno(), 1)
+                os.dup2(stderr_file.fileno(), 2)
+                import pytest
+                returncode = int(pytest.main(args))
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(returncode)
+
+        start = time.perf_counter()
+        timed_out = False
+        while True:
+            done, status = os.waitpid(pid, os.WNOHANG)
+            if done:
+                break
+            if timeout and time.perf_counter() - start > timeout:
+                timed_out = True
+                os.killpg(pid, signal.SIGKILL)
+                _, status = os.waitpid(pid, 0)
+                break
+            time.sleep(0.005)
+
+        # Processes the run left behind in the background are killed with it
+        if not timed_out:
+            try:
+                os.killpg(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+        outputs = []
+        for output_file in [stdout_file, stderr_file]:
+            output_file.seek(0)
+            outputs.append(output_file.read().decode("utf-8", errors="replace"))
+
+    returncode = os.waitstatus_to_exitcode(status) if hasattr(os, "waitstatus_to_exitcode") else status >> 8
+    return {
+        "returncode": returncode,
+        "stdout": outputs[0],
+        "stderr": outputs[1],
+        "status": sandbox.exec_status(returncode, outputs[0] + outputs[1], timed_out, limits)
+    }
+
+# Worker loop: import pytest and the given modules, then answer one JSON request per line until stdin is closed
+def serve(preload, module_mode, test_file=None):
+    # Replies go through a copy of stdout; anything printed while importing goes to stderr instead
+    replies = os.fdopen(os.dup(1), "w")
+    os.dup2(2, 1)
+
+    # Same sys.path as pytest (or python -m pytest) started in the checkout, without this script's directory, and with
+    # the directories pytest inserts for the test file, so that the project's modules (and names like `test` that exist
+    # both in the checkout and in the standard library) are imported from the same place as in a run
+    sys.path.pop(0)
+    if module_mode:
+        sys.path.insert(0, os.getcwd())
+    if test_file is not None:
+        for directory in pytest_import_dirs(os.getcwd(), test_file):
+            if directory not in sys.path:
+                sys.path.insert(0, directory)
+
+    import pytest
+    for module in preload:
+        try:
+            importlib.import_module(module)
+        except Exception:
+            pass
+
+    # Load pytest's plugins and the checkout's initial conftest.py files once (they stay imported in the forked children;
+    # with the sys.path above, whatever they import resolves as in a run)
+    pytest.main(["--help"])
+
+    replies.write("ready\n")
+    replies.flush()
+
+    for line in sys.stdin:
+        request = json.loads(line)
+        replies.write(json.dumps(fork_run(request["args"], request.get("limits"))) + "\n")
+        replies.flush()
+
+if __name__ == "__main__" and len(sys.argv) > 1 and sys.argv[1] == "--serve":
+    module_mode = "--module-mode" in sys.argv
+    test_files = [name.split("=", 1)[1] for name in sys.argv[2:] if name.startswith("--test-file=")]
+    serve([name for name in sys.argv[2:] if not name.startswith("--")], module_mode, test_files[0] if test_files else None)
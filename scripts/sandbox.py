@@ -0,0 +1,154 @@
+from pathlib import Path
+import sys
+import os
+import re
+import signal
+import subprocess
+import tempfile
+import venv_pool
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# LLM-generated tests are untrusted, so every pytest run of p02, p04, p05 and p06 goes through this module: it runs in its
+# own process group with a wall-clock timeout, optional CPU time and memory limits (rlimits) and a private temp directory
+
+# How a run ended (recorded in the exec_status column)
+OK = "ok"                   # pytest exited by itself (whatever its exit code)
+TIMEOUT = "timeout"         # killed after running longer than the timeout
+CPU_TIME = "cpu_time"       # stopped by the CPU time limit
+MEMORY = "memory"           # ran out of the memory limit (or was killed by the kernel's OOM killer)
+CRASHED = "crashed"         # killed by another signal (e.g. a segfault)
+
+# Add the options that set the limits of a run
+def add_arguments(parser, timeout):
+    parser.add_argument(
+        "-t", "--timeout",
+        type=int,
+        default=timeout,
+        help=f"seconds before a pytest run (and every process it started) is killed (default: {timeout})."
+    )
+
+    parser.add_argument(
+        "--cpu-limit",
+        type=int,
+        default=0,
+        help="CPU seconds a pytest run may use (0 = no limit)."
+    )
+
+    parser.add_argument(
+        "--memory-limit",
+        type=int,
+        default=0,
+        help="MB of memory (address space) a pytest run may use (0 = no limit)."
+    )
+
+# Limits of a run from the parsed options ({"timeout", "cpu", "memory"}, where 0 or None means no limit)
+def limits_from_args(args):
+    return {"timeout": args.timeout, "cpu": args.cpu_limit, "memory": args.memory_limit}
+
+# Set the CPU time and memory rlimits of the current process (inherited by everything it starts)
+def apply_limits(limits):
+    if resource is None or not limits:
+        return
+    if limits.get("cpu"):
+        # The soft limit sends SIGXCPU, the hard limit a second later SIGKILL
+        resource.setrlimit(resource.RLIMIT_CPU, (limits["cpu"], limits["cpu"] + 1))
+    if limits.get("memory"):
+        memory = limits["memory"] * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+
+# Environment (with the variables in `extra_env`) with a private temp directory, so that runs don't share (or leave
+# behind) temp files
+def private_env(temp_dir, extra_env=None):
+    env = dict(os.environ, **(extra_env or {}))
+    for name in ["TMPDIR", "TEMP", "TMP"]:
+        env[name] = str(temp_dir)
+    return env
+
+# A MemoryError that was raised and not caught: the exception line of a failure in pytest's report ("E       MemoryError"),
+# or the last line of the output (a traceback that ended the process). Tests that only print or assert on the name don't count
+def raised_memory_error(output):
+    lines = [line for line in (output or "").splitlines() if line.strip()]
+    if lines and re.match(r"MemoryError(:|$)", lines[-1]):
+        return True
+    return any(re.match(r"E\s+MemoryError(:|$)", line) for line in lines)
+
+# Work out how a run ended from its return code and output
+def exec_status(returncode, output, timed_out, limits):
+    limits = limits or {}
+    if timed_out:
+        return TIMEOUT
+    if returncode is None or returncode >= 0:
+        # Python raises MemoryError when an allocation hits the memory limit (pytest reports it as a failure)
+        if limits.get("memory") and raised_memory_error(output):
+            return MEMORY
+        return OK
+    if hasattr(signal, "SIGXCPU") and returncode == -signal.SIGXCPU:
+        return CPU_TIME
+    if returncode == -signal.SIGKILL and limits.get("cpu"):
+        return CPU_TIME
+    if returncode == -signal.SIGKILL or (limits.get("memory") and returncode in [-signal.SIGABRT, -signal.SIGSEGV]):
+        return MEMORY
+    return CRASHED
+
+# Kill a process and every process it started (they share its process group). On Windows, the tree is only killed while
+# the process is still running: once it has exited, its PID may belong to another process (and taskkill can't find the
+# children it left behind)
+def kill_process_group(process):
+    if os.name == "nt":
+        if process.poll() is None:
+            subprocess.run(["taskkill", "/F", "/T", "/PID", str(process.pid)], capture_output=True)
+    else:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+# Run a command in its own process group with a private temp directory and the given limits, killing the whole group
+# once it has finished or if it runs longer than the timeout (returns the completed process and its exec status). `cwd` is
+# a checkout, whose own source is imported first in a pooled environment (see venv_pool.checkout_env)
+def run(command, cwd, limits=None, stderr=None, extra_env=None):
+    limits = limits or {}
+    if os.name == "nt":
+        group = {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+    else:
+        group = {"start_new_session": True}
+
+    # The rlimits are set by this script started in between, which then replaces itself with the command
+    # (setting them in a preexec_fn isn't safe in the threads of p02)
+    launcher = []
+    if resource is not None and (limits.get("cpu") or limits.get("memory")):
+        launcher = [sys.executable, str(Path(__file__).absolute()), "--exec", str(limits.get("cpu") or 0),
+                    str(limits.get("memory") or 0), "--"]
+
+    with tempfile.TemporaryDirectory(prefix="sandbox_") as temp_dir:
+        process = subprocess.Popen(
+            launcher + [str(part) for part in command],
+            cwd=str(cwd),
+            stdout=subprocess.PIPE,
+            stderr=stderr,
+            env=private_env(temp_dir, dict(venv_pool.checkout_env(cwd, command[0]), **(extra_env or {}))),
+            text=True,
+            **group
+        )
+        timed_out = False
+        try:
+            stdout, stderr_output = process.communicate(timeout=limits.get("timeout") or None)
+        except subprocess.TimeoutExpired:
+            timed_out = True
+            kill_process_group(process)
+            stdout, stderr_output = process.communicate()
+
+        # Processes the run left behind in the background (e.g. a server a test started) are killed with it (not on
+        # Windows, see kill_process_group)
+        kill_process_group(process)
+
+    status = exec_status(process.returncode, (stdout or "") + (stderr_output or ""), timed_out, limits)
+    return subprocess.CompletedProcess(command, process.returncode, stdout, stderr_output), status
+
+if __name__ == "__main__" and len(sys.argv) > 4 and sys.argv[1] == "--exec":
+    apply_limits({"cpu": int(sys.argv[2]), "memory": int(sys.argv[3])})
+    os.execvp(sys.argv[5], sys.argv[5:])
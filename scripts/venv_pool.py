@@ -0,0 +1,177 @@
+from pathlib import Path
+import sys
+import os
+import subprocess
+import hashlib
+import time
+
+# Files that define the dependencies of a checkout (buggy versions where these are identical share one environment)
+DEPENDENCY_FILES = [
+    "setup.py",
+    "setup.cfg",
+    "pyproject.toml",
+    "requirements.txt",
+    "requirements-dev.txt",
+    "requirements_dev.txt",
+    "test-requirements.txt",
+    "tests/requirements.txt",
+]
+
+# Test tools that the pipeline runs inside every environment
+PIPELINE_PACKAGES = ["pytest", "pytest-cov", "pytest-xdist"]
+
+# Extra test tools needed by a project's test file
+PROJECT_PACKAGES = {
+    "scrapy": ["pytest-twisted"],
+}
+
+SCRIPTS_DIR = Path(__file__).absolute().parent
+ENVS_DIR = SCRIPTS_DIR / "envs"
+WHEELS_DIR = SCRIPTS_DIR / "wheels"
+
+# Directories of a checkout that its packages are imported from (like the editable install of a flat, src or lib layout)
+IMPORT_DIRS = ["src", "lib", "."]
+
+# Marks a checkout whose extension modules were built in place
+BUILD_EXT_FILE = ".t4p_build_ext_done"
+
+READY_FILE = ".ready"
+FAILED_FILE = ".failed"
+LOCK_FILE = ".lock"
+
+# Hash the dependency files of a checkout and the driver's Python version into an environment name
+def env_key(project, project_dir):
+    digest = hashlib.sha256(sys.version.encode())
+
+    for name in DEPENDENCY_FILES:
+        dependency_file = project_dir / name
+        if dependency_file.is_file():
+            digest.update(name.encode())
+            digest.update(dependency_file.read_bytes())
+    return f"{project}-{digest.hexdigest()[:12]}"
+
+# Path to an executable (python, pytest) inside an environment
+def env_executable(env_dir, name):
+    if os.name == "nt":
+        return env_dir / "Scripts" / f"{name}.exe"
+    return env_dir / "bin" / name
+
+# Take the build lock of an environment, or wait while another process builds it
+def acquire_lock(env_dir):
+    lock = env_dir / LOCK_FILE
+    waiting = False
+
+    while True:
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            os.write(fd, str(os.getpid()).encode())
+            os.close(fd)
+            return True
+        except FileExistsError:
+            if (env_dir / READY_FILE).exists() or (env_dir / FAILED_FILE).exists():
+                return False
+            if not waiting:
+                print(f"WAITING FOR ENVIRONMENT {env_dir.name} (delete {lock} if no other script is building it) ...")
+                waiting = True
+            time.sleep(5)
+
+# Run pip inside an environment, using the local wheel cache first (and only, when offline)
+def pip(env_python, args, cwd, offline):
+    command = [str(env_python), "-m", "pip"] + args + ["--find-links", str(WHEELS_DIR)]
+    if offline:
+        command.append("--no-index")
+    return subprocess.run(command, cwd=str(cwd))
+
+# Build an isolated virtual environment with the checkout's dependencies and the pipeline's test tools
+def build_env(project, project_dir, env_dir, offline):
+    env_python = env_executable(env_dir, "python")
+    packages = PIPELINE_PACKAGES + PROJECT_PACKAGES.get(project, [])
+
+    print(f"CREATING ENVIRONMENT {env_dir.name} ...")
+    result = subprocess.run([sys.executable, "-m", "venv", str(env_dir)])
+    if result.returncode != 0:
+        return result
+
+    # Install the project's packages (as with the driver interpreter before) to ensure that it is compatible
+    result = pip(env_python, ["install"] + packages + ["-e", "."], project_dir, offline)
+    if result.returncode != 0:
+        return result
+
+    # Store wheels of every installed dependency locally so that later rebuilds also work offline
+    if not offline:
+        freeze = subprocess.run(
+            [str(env_python), "-m", "pip", "freeze", "--exclude-editable"],
+            stdout=subprocess.PIPE,
+            text=True
+        )
+        requirements = env_dir / "requirements.lock"
+        requirements.write_text(freeze.stdout, encoding="utf-8")
+
+        WHEELS_DIR.mkdir(exist_ok=True)
+        pip(env_python, ["wheel", "--wheel-dir", str(WHEELS_DIR), "-r", str(requirements)], project_dir, offline)
+    return result
+
+# Environment variables that make a run of `executable` (an interpreter or script of a pooled environment) import the
+# checkout it runs in. A pooled environment only shares the dependencies: its editable install points at the checkout
+# that built it, so every checkout puts its own import directories first on sys.path (PYTHONPATH comes before
+# site-packages and the editable install's paths and finders). Other interpreters (--env system) are left as they are,
+# since the uncompiled source tree would shadow the extension modules of the installed project
+def checkout_env(project_dir, executable):
+    if ENVS_DIR not in Path(executable).absolute().parents:
+        return {}
+
+    paths = [str((Path(project_dir) / name).absolute()) for name in IMPORT_DIRS if (Path(project_dir) / name).is_dir()]
+    if os.environ.get("PYTHONPATH"):
+        paths.append(os.environ["PYTHONPATH"])
+    return {"PYTHONPATH": os.pathsep.join(paths)}
+
+# Build the extension modules of a checkout in place once (the editable install only built them for the checkout that
+# built the environment)
+def build_extensions(env_python, project_dir):
+    setup_py = project_dir / "setup.py"
+    if (project_dir / BUILD_EXT_FILE).exists() or not setup_py.is_file():
+        return
+    if "ext_modules" not in setup_py.read_text(encoding="utf-8", errors="replace"):
+        return
+
+    print(f"BUILDING EXTENSION MODULES OF {project_dir.name} ...")
+    result = subprocess.run([str(env_python), "setup.py", "build_ext", "--inplace"], cwd=str(project_dir))
+    if result.returncode == 0:
+        (project_dir / BUILD_EXT_FILE).write_text("", encoding="utf-8")
+
+# Return the Python interpreter of the environment for a checkout, building the environment if needed
+# (returns None if the project's packages can't be installed)
+def get_python(project, project_dir, offline=False):
+    if not project_dir.is_dir():
+        return None
+
+    env_dir = ENVS_DIR / env_key(project, project_dir)
+    env_python = env_executable(env_dir, "python")
+    env_dir.mkdir(parents=True, exist_ok=True)
+
+    if not (env_dir / READY_FILE).exists() and not (env_dir / FAILED_FILE).exists():
+        if acquire_lock(env_dir):
+            try:
+                # Another process may have finished the environment between the check above and taking the lock
+                if not (env_dir / READY_FILE).exists() and not (env_dir / FAILED_FILE).exists():
+                    result = build_env(project, project_dir, env_dir, offline)
+                    marker = READY_FILE if result.returncode == 0 else FAILED_FILE
+                    (env_dir / marker).write_text(str(project_dir), encoding="utf-8")
+            finally:
+                (env_dir / LOCK_FILE).unlink()
+
+    if (env_dir / FAILED_FILE).exists():
+        return None
+    build_extensions(env_python, project_dir)
+    return env_python
+
+# Select the interpreter for a checkout: its pooled environment, or the driver interpreter with --env system (None if
+# the environment can't be built)
+def select_python(env_mode, project, project_dir, offline=False):
+    if env_mode == "system":
+        return Path(sys.executable)
+    return get_python(project, project_dir, offline)
+
+# Path to the pytest executable that belongs to an interpreter
+def pytest_executable(python):
+    return python.with_name("pytest.exe" if os.name == "nt" else "pytest")